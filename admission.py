@@ -0,0 +1,210 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from metrics import increment, observe
+
+# Defaults, can be overridden in the secrets
+MAX_CONCURRENT_SEARCHES = 8
+MAX_CONCURRENT_LLM_CALLS = 4
+QUEUE_TIMEOUT = 120  # seconds a request waits for a slot before giving up
+RATE_LIMIT = 6  # requests per session ...
+RATE_WINDOW = 60  # ... within this many seconds
+FLIGHT_TIMEOUT = 600  # seconds a coalesced request waits for the shared result
+
+
+class QueueTimeout(Exception):
+    pass
+
+
+class FlightAbandoned(Exception):
+    """
+    Raised to requests waiting on a shared execution whose owner stopped or failed before finishing,
+    e.g. because the user reran the page. SingleFlight.join then lets a waiting request claim it and run it itself.
+    """
+
+    def __init__(self):
+        super().__init__("The shared execution was stopped before finishing")
+
+
+def request_key(**parts):
+    """
+    Hashes the parts that make two requests identical, e.g. the question vector, indexes and filters.
+    """
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class AdmissionController:
+    """
+    Bounded number of concurrent executions, shared by all sessions.
+    Requests beyond the limit wait in a first-come, first-served queue.
+    """
+
+    def __init__(self, max_concurrent, name, timeout=QUEUE_TIMEOUT):
+        self.max_concurrent = max_concurrent
+        self.name = name
+        self.timeout = timeout
+        self.active = 0
+        self._queue = deque()
+        self._condition = threading.Condition()
+
+    def acquire(self, on_wait=None):
+        """
+        Waits for a free slot. While queued, on_wait is called with the 1-based queue position whenever it changes.
+        Raises QueueTimeout if no slot is free within the timeout.
+        """
+        ticket = object()
+        start = time.perf_counter()
+        with self._condition:
+            self._queue.append(ticket)
+            position = None
+            try:
+                while self._queue[0] is not ticket or self.active >= self.max_concurrent:
+                    if on_wait and self._queue.index(ticket) + 1 != position:
+                        position = self._queue.index(ticket) + 1
+                        on_wait(position)
+                    remaining = self.timeout - (time.perf_counter() - start)
+                    if remaining <= 0:
+                        increment(f'{self.name}_queue_timeouts')
+                        raise QueueTimeout(f"No free {self.name} slot within {self.timeout} s")
+                    self._condition.wait(min(remaining, 0.5))
+                self.active += 1
+            finally:
+                self._queue.remove(ticket)
+                self._condition.notify_all()
+        observe(f'{self.name}_queue_wait', time.perf_counter() - start)
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, on_wait=None):
+        self.acquire(on_wait)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        with self._condition:
+            return {'active': self.active, 'waiting': len(self._queue)}
+
+
+class RateLimiter:
+    """
+    Sliding window limit of max_requests per window seconds, counted per session.
+    """
+
+    def __init__(self, max_requests=RATE_LIMIT, window=RATE_WINDOW):
+        self.max_requests = max_requests
+        self.window = window
+        self._requests = {}
+        self._lock = threading.Lock()
+
+    def check(self, session_id):
+        """
+        Records a request of the session if it is within the limit.
+        Returns:
+            float: 0 if the request is allowed, otherwise the seconds until the session may send the next one.
+        """
+        now = time.time()
+        with self._lock:
+            requests = self._requests.setdefault(session_id, deque())
+            while requests and requests[0] <= now - self.window:
+                requests.popleft()
+            if len(requests) >= self.max_requests:
+                increment('rate_limited')
+                return requests[0] + self.window - now
+            requests.append(now)
+            # forget sessions that were idle for a whole window
+            for other in [other for other, times in self._requests.items() if times[-1] <= now - self.window]:
+                del self._requests[other]
+            return 0.0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical requests: the first caller for a key runs it,
+    callers arriving while it runs wait for and share its result.
+    """
+
+    def __init__(self, timeout=FLIGHT_TIMEOUT):
+        self.timeout = timeout
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def claim(self, key):
+        """
+        Returns:
+            tuple: The Future of the execution for key, and whether the caller owns it (and must resolve it).
+        """
+        with self._lock:
+            future = self._flights.get(key)
+            if future is not None:
+                increment('coalesced_requests')
+                return future, False
+            future = self._flights[key] = Future()
+            return future, True
+
+    def resolve(self, key, result=None, exception=None):
+        """
+        Finishes the execution owned by the caller, with its result or exception.
+        """
+        with self._lock:
+            future = self._flights.pop(key, None)
+        if future is None or future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def join(self, key, on_wait=None):
+        """
+        Waits for the identical execution in flight, or claims key if there is none.
+        If the execution is abandoned, the caller claims it (or waits for whoever claimed it first).
+        on_wait is called before waiting.
+        Returns:
+            tuple: The shared result and False, or None and True if the caller owns the execution
+            (and must resolve it).
+        """
+        while True:
+            future, owner = self.claim(key)
+            if owner:
+                return None, True
+            if on_wait:
+                on_wait()
+            try:
+                return future.result(timeout=self.timeout), False
+            except FlightAbandoned:
+                logging.info(f"Shared execution {key} was abandoned, running it again")
+
+    def do(self, key, fn):
+        """
+        Returns fn(), or the result of the identical execution already in flight.
+        """
+        result, owner = self.join(key)
+        if not owner:
+            return result
+        try:
+            result = fn()
+        except Exception as e:
+            self.resolve(key, exception=e)
+            raise
+        except BaseException:
+            self.resolve(key, exception=FlightAbandoned())
+            raise
+        self.resolve(key, result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': len(self._flights)}
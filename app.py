@@ -2,21 +2,11 @@ import os
 import streamlit as st
 import time
 
-import plotly.express as px
 import streamlit.components.v1 as components
 
-from langchain import hub
 from datetime import datetime
-from langchain import callbacks
-from elasticsearch import Elasticsearch
-from elasticsearch import BadRequestError
-from elasticsearch.exceptions import NotFoundError
-from angle_emb import AnglE, Prompts
-from langchain_openai import ChatOpenAI
 from authentificate import check_password
-from utils import (display_distribution_charts,populate_default_values, project_indexes,
-                   populate_terms,create_must_term, create_dataframe_from_response,flat_index_list,
-                   search_elastic_below_threshold)
+from metrics import Trace, timed, register_gauge, start_metrics_server
 
 
 # Init Langchain and Langsmith services
@@ -26,17 +16,17 @@ os.environ["LANGCHAIN_ENDPOINT"] = "https://api.smith.langchain.com"
 os.environ["LANGCHAIN_API_KEY"] = st.secrets['ld_rag']['LANGCHAIN_API_KEY']
 os.environ["LANGSMITH_ACC"] = st.secrets['ld_rag']['LANGSMITH_ACC']
 
-
-# Init openai model
 OPENAI_API_KEY = st.secrets['ld_rag']['OPENAI_KEY_ORG']
-llm_chat = ChatOpenAI(temperature=0.0, openai_api_key=OPENAI_API_KEY,
-             model_name='gpt-4-1106-preview')
 
 es_config = {
     'host': st.secrets['ld_rag']['ELASTIC_HOST'],
     'port': st.secrets['ld_rag']['ELASTIC_PORT'],
     'api_key': st.secrets['ld_rag']['ELASTIC_API']
 }
+# Send one kNN request per index instead of one request for all selected indexes
+es_fan_out = st.secrets['ld_rag'].get('ELASTIC_FAN_OUT', False)
+# 'knn' (default), 'hybrid' (lexical + kNN fused in the app) or 'hybrid_es' (fused by an ES rrf retriever)
+retrieval_mode = st.secrets['ld_rag'].get('RETRIEVAL_MODE', 'knn')
 
 ########## APP start ###########
 st.set_page_config(layout="wide")
@@ -60,35 +50,75 @@ with st.expander("Learn more about the app"):
     st.markdown(markdown_content, unsafe_allow_html=True)
 
 # Authorise user
-if not check_password():
+with timed('password_check'):
+    password_correct = check_password()
+if not password_correct:
     st.stop()
 
-# Get input parameters
-st.markdown('### Please select search parameters ')
-
-url = f'{os.environ["LANGSMITH_ACC"]}/simple-rag:9388b291'
-prompt_template = hub.pull(url)
+# Heavy dependencies (langchain, elasticsearch, torch) are only imported once the user is logged in
+from elasticsearch import BadRequestError
+from elasticsearch.exceptions import NotFoundError
+from admission import (AdmissionController, RateLimiter, SingleFlight, QueueTimeout,
+                       MAX_CONCURRENT_SEARCHES, MAX_CONCURRENT_LLM_CALLS, RATE_LIMIT)
+from llm import init_answer_cache, load_prompt, create_chat_model, PROMPT_NAME
+from pipeline import answer_question
+from batch import read_questions, run_batch
+from embeddings import set_backend, start_preload, init_vector_cache, QuestionDebouncer
+from utils import (display_distribution_charts,populate_default_values, project_indexes,
+                   populate_terms,create_must_term,flat_index_list,
+                   search_elastic_below_threshold, retrieval_cache,
+                   index_display_mapping, display_index_mapping, project_display_mapping, display_project_mapping)
 
-# Mappings for indexes
-index_display_mapping = {
-    "telegram": "ua-by-telegram",
-    "web": "ua-by-web",
-    "facebook": "ua-by-facebook",
-    "youtube": "ua-by-youtube"
-}
 
-selected_indexes = []
+# Init openai model
+@st.cache_resource
+def load_chat_model(openai_api_key):
+    return create_chat_model(openai_api_key)
+
+
+llm_chat = load_chat_model(OPENAI_API_KEY)
+
+# Summaries for repeated questions over the same documents are replayed from the cache.
+# ANSWER_SIMILARITY (e.g. 0.97) also reuses answers for near-identical questions.
+answer_cache = init_answer_cache(similarity_threshold=st.secrets['ld_rag'].get('ANSWER_SIMILARITY'),
+                                 path=st.secrets['ld_rag'].get('ANSWER_CACHE_PATH'))
+
+# Server-wide limits on expensive work, shared by all sessions: bounded numbers of concurrent searches
+# and LLM calls (later requests wait in a queue), a per-session rate limit, and coalescing of identical
+# requests that run at the same time
+@st.cache_resource
+def load_admission(max_searches, max_llm_calls, rate_limit):
+    return (AdmissionController(max_searches, 'search'), AdmissionController(max_llm_calls, 'llm'),
+            RateLimiter(rate_limit), SingleFlight(), SingleFlight())
+
+
+search_slots, llm_slots, rate_limiter, search_flights, answer_flights = load_admission(
+    st.secrets['ld_rag'].get('MAX_CONCURRENT_SEARCHES', MAX_CONCURRENT_SEARCHES),
+    st.secrets['ld_rag'].get('MAX_CONCURRENT_LLM_CALLS', MAX_CONCURRENT_LLM_CALLS),
+    st.secrets['ld_rag'].get('SEARCH_RATE_LIMIT', RATE_LIMIT))
+
+# Load the question encoder in the background while the user fills in the form
+set_backend(st.secrets['ld_rag'].get('ENCODER_BACKEND', 'fp32'))
+vector_cache = init_vector_cache(path=st.secrets['ld_rag'].get('EMBEDDING_CACHE_PATH'))
+start_preload()
+
+# Per-stage timings are logged as JSON for every search, and served on a local
+# Prometheus endpoint if METRICS_PORT is set
+caches = {'question_vectors': vector_cache, 'retrieval': retrieval_cache, 'answers': answer_cache}
+register_gauge('cache_hits', 'cache', lambda: {name: cache.stats()['hits'] for name, cache in caches.items()})
+register_gauge('cache_misses', 'cache', lambda: {name: cache.stats()['misses'] for name, cache in caches.items()})
+slot_pools = {'search': search_slots, 'llm': llm_slots}
+register_gauge('slots_active', 'pool', lambda: {name: pool.stats()['active'] for name, pool in slot_pools.items()})
+register_gauge('slots_waiting', 'pool', lambda: {name: pool.stats()['waiting'] for name, pool in slot_pools.items()})
+if st.secrets['ld_rag'].get('METRICS_PORT'):
+    start_metrics_server(int(st.secrets['ld_rag']['METRICS_PORT']))
 
-# Reverse mapping to display names
-display_index_mapping = {v: k for k, v in index_display_mapping.items()}
+# Get input parameters
+st.markdown('### Please select search parameters ')
 
-# Mapping for project
-project_display_mapping = {
-    "Ua By": "ua-by"
-}
+prompt_template = load_prompt(f'{os.environ["LANGSMITH_ACC"]}/{PROMPT_NAME}')
 
-# Reverse mapping for projects
-display_project_mapping = {v: k for k, v in project_display_mapping.items()}
+selected_indexes = []
 
 selected_index = None
 search_option = st.radio("Choose 'Specific platforms' if you want to search one or more different platforms, choose 'All platforms for project' to select all platforms within a project.",
@@ -116,19 +146,27 @@ else:
         st.write(f"We'll search in: {', '.join([display_index_mapping[idx] for idx in selected_indexes])}")
     selected_index = ",".join(selected_indexes)
 
-if selected_index:
-    category_values, language_values, country_values = populate_default_values(selected_index, es_config)
 
+# Changing a filter only reruns this fragment, the selection is read from session_state on the next full run
+@st.fragment
+def refine_filters(category_values, language_values, country_values):
     with st.popover("Tap to refine filters"):
         st.markdown("Hihi 👋")
         st.markdown("If Any remains selected or no values at all, filtering will not be applied to this field. Start typing to find the option faster.")
-        categories_selected = st.multiselect('Select "Any" or choose one or more categories', category_values, default=['Any'])
-        languages_selected = st.multiselect('Select "Any" or choose one or more languages', language_values, default=['Any'])
-        countries_selected = st.multiselect('Select "Any" or choose one or more countries', country_values, default=['Any'])
+        st.multiselect('Select "Any" or choose one or more categories', category_values, default=['Any'], key='categories_selected')
+        st.multiselect('Select "Any" or choose one or more languages', language_values, default=['Any'], key='languages_selected')
+        st.multiselect('Select "Any" or choose one or more countries', country_values, default=['Any'], key='countries_selected')
 
-    category_terms = populate_terms(categories_selected, 'category.keyword')
-    language_terms = populate_terms(languages_selected, 'language.keyword')
-    country_terms = populate_terms(countries_selected, 'country.keyword')
+
+if selected_index:
+    with timed('facet_loading'):
+        category_values, language_values, country_values = populate_default_values(selected_index, es_config)
+
+    refine_filters(category_values, language_values, country_values)
+
+    category_terms = populate_terms(st.session_state.get('categories_selected'), 'category.keyword')
+    language_terms = populate_terms(st.session_state.get('languages_selected'), 'language.keyword')
+    country_terms = populate_terms(st.session_state.get('countries_selected'), 'country.keyword')
 
 
 # Get input dates
@@ -153,108 +191,153 @@ st.markdown('### Please enter your question')
 input_question = st.text_input("Enter your question here (phrased as if you ask a human)")
 
 
-if input_question:
+# Results of the last search are kept in session_state, so other interactions do not repeat the search.
+# Interacting with the results only reruns this fragment.
+@st.fragment
+def show_results(result):
+    if result['failed_indexes']:
+        st.warning(f"These platforms did not respond in time and were skipped: "
+                   f"{', '.join(display_index_mapping[idx] for idx in result['failed_indexes'])}")
+    st.markdown(f'### This is a summary for your question:')
+    st.caption(result['question'])
+    st.markdown(result['answer'])
+    st.write('******************')
 
-    @st.cache_resource(hash_funcs={"_thread.RLock": lambda _: None, "builtins.weakref": lambda _: None})
-    def load_model():
-        angle_model = AnglE.from_pretrained('WhereIsAI/UAE-Large-V1',
-                                            pooling_strategy='cls')
-        return angle_model
-
-    # Create question embedding
-    angle = load_model()
-    vec = angle.encode({'text': input_question}, to_numpy=True, prompt=Prompts.C)
-    question_vector = vec.tolist()[0]
-
-    # # Get input dates
-    # default_start_date = datetime(2024, 1, 1)
-    # default_end_date = datetime(2024, 1, 15)
-    #
-    # selected_start_date = st.date_input("Select start date:", default_start_date)
-    # formatted_start_date = selected_start_date.strftime("%Y-%m-%d")
-    # st.write("You selected start date:", selected_start_date)
-    # selected_end_date = st.date_input("Select end date:", default_end_date)
-    # formatted_end_date = selected_end_date.strftime("%Y-%m-%d")
-    # st.write("You selected end date:", selected_end_date)
-    # must_term = create_must_term(category_terms,
-    #                              language_terms,
-    #                              country_terms,
-    #                              formatted_start_date=formatted_start_date,
-    #                              formatted_end_date=formatted_end_date)
+    st.markdown(f'### These are top {result["max_doc_num"]} texts used for summary generation:')
+    st.dataframe(result['df'])
+    display_distribution_charts(result['df'])
+
+    tally_form_url = f'https://tally.so/embed/n0PA7P?alignLeft=1&hideTitle=1&transparentBackground=1&dynamicHeight=1&run_id={result["run_id"]}&time={result["execution_time"]}'
+    components.iframe(tally_form_url, width=700, height=800, scrolling=True)
+
+
+if input_question:
 
+    # Start the question embedding, questions from all sessions are encoded in shared batches.
+    # It is debounced: the question is encoded once it stayed unchanged for a moment, in the background
+    # while the user fills in the rest of the form, and RUN SEARCH encodes it right away if still waiting.
+    # The debouncer is kept for the session, so the question is only encoded again when it changes
+    # (or when encoding it failed).
+    if 'question_debouncer' not in st.session_state:
+        st.session_state['question_debouncer'] = QuestionDebouncer()
+    question_debouncer = st.session_state['question_debouncer']
+    question_debouncer.update(input_question)
 
     if formatted_start_date and formatted_end_date:
 
         # Run search
-        if st.button('RUN SEARCH', type="primary"):
+        run_search = st.button('RUN SEARCH', type="primary")
+        retry_after = rate_limiter.check(st.session_state.get('session_id')) if run_search else 0
+        if retry_after:
+            st.warning(f'You have run {rate_limiter.max_requests} searches within a minute, '
+                       f'please try again in {int(retry_after) + 1} seconds.')
+        elif run_search:
+            st.session_state.pop('search_result', None)
             start_time = time.time()
             max_doc_num=30
+            trace = Trace(index=selected_index, fan_out=bool(es_fan_out), retrieval_mode=retrieval_mode)
+            queue_note = st.empty()
+            st.write(f'Running search for relevant posts for question: {input_question}')
+            status_container = st.container()
+            # The summary goes above the sources, but the sources are rendered first,
+            # while the model is still generating
+            summary_container = st.container()
+            sources_container = st.container()
+
+            def show_queue_position(position):
+                if position:
+                    queue_note.info(f'Many searches are running right now, yours is number {position} in the queue...')
+                else:
+                    queue_note.empty()
+
+            def show_retrieved(response):
+                with status_container:
+                    if response.get('failed_indexes'):
+                        st.warning(f"These platforms did not respond in time and were skipped: "
+                                   f"{', '.join(display_index_mapping[idx] for idx in response['failed_indexes'])}")
+                    st.write("Searching for documents, please wait 15 seconds on average to finish...")
+
+            def show_sources(df):
+                with sources_container:
+                    st.markdown(f'### These are top {max_doc_num} texts used for summary generation:')
+                    st.dataframe(df)
+                    display_distribution_charts(df)
+
+            def show_summary(summary_stream):
+                with summary_container:
+                    st.markdown(f'### This is a summary for your question:')
+                    answer = st.write_stream(summary_stream)
+                    st.write('******************')
+                return answer
+
             try:
-                texts_list = []
-                st.write(f'Running search for relevant posts for question: {input_question}')
-                try:
-                    es = Elasticsearch(f'https://{es_config["host"]}:{es_config["port"]}', api_key=es_config["api_key"], request_timeout=600)
-                except Exception as e:
-                    st.error(f'Failed to connect to Elasticsearch: {str(e)}')
-
-                response = es.search(index=selected_index,
-                                     size=max_doc_num,
-                                     knn={"field": "embeddings.WhereIsAI/UAE-Large-V1",
-                                          "query_vector":  question_vector,
-                                          "k": max_doc_num,
-                                          "num_candidates": 10000,
-                                          "filter": {
-                                              "bool": {
-                                                  "must": must_term,
-                                                  "must_not": [{"term": {"type": "comment"}}]
-                                              }
-                                          }
-                                          }
-                                     )
-
-                for doc in response['hits']['hits']:
-                    texts_list.append((doc['_source']['translated_text'], doc['_source']['url']))
-
-                st.write("Searching for documents, please wait 15 seconds on average to finish...")
-
-                # Format urls so they work properly within streamlit
-                corrected_texts_list = [(text, 'https://' + url if not url.startswith('http://') and not url.startswith(
-                    'https://') else url) for text, url in texts_list]
-
-                # Get summary for the retrieved data
-                customer_messages = prompt_template.format_messages(
-                    question=input_question,
-                    texts=corrected_texts_list)
-
-                # Print GPT summary
-                st.markdown(f'### This is a summary for your question:')
-
-                with callbacks.collect_runs() as cb:
-                    st.write_stream(llm_chat.stream(customer_messages))
-                    run_id = cb.traced_runs[0].id
-
-                # st.markdown(content)
-                st.write('******************')
-                end_time = time.time()
+                result = answer_question(
+                    es_config, selected_index, input_question, question_debouncer, must_term, llm_chat,
+                    prompt_template, answer_cache, search_slots, llm_slots, search_flights, answer_flights, trace,
+                    retrieval_mode=retrieval_mode, fan_out=es_fan_out, max_doc_num=max_doc_num,
+                    render_sources=show_sources, render_summary=show_summary, on_queue=show_queue_position,
+                    on_shared_wait=lambda: queue_note.info('The same question is being answered right now, '
+                                                           'waiting for that answer...'),
+                    on_retrieved=show_retrieved,
+                    while_loading=lambda: st.spinner('The language model is still loading, '
+                                                     'this only happens after a restart...'))
 
-                # Display tables
-                st.markdown(f'### These are top {max_doc_num} texts used for summary generation:')
-                df = create_dataframe_from_response(response)
-                st.dataframe(df)
-                display_distribution_charts(df)
+                end_time = time.time()
+                trace.record('total', end_time - start_time)
+                trace.log()
 
                 # Send rating to Tally
                 execution_time = round(end_time - start_time, 2)
-                tally_form_url = f'https://tally.so/embed/n0PA7P?alignLeft=1&hideTitle=1&transparentBackground=1&dynamicHeight=1&run_id={run_id}&time={execution_time}'
+                tally_form_url = f'https://tally.so/embed/n0PA7P?alignLeft=1&hideTitle=1&transparentBackground=1&dynamicHeight=1&run_id={result["run_id"]}&time={execution_time}'
                 components.iframe(tally_form_url, width=700, height=800, scrolling=True)
 
+                st.session_state['search_result'] = {**result, 'execution_time': execution_time}
 
             except BadRequestError as e:
                 st.error(f'Failed to execute search (embeddings might be missing for this index): {e.info}')
             except NotFoundError as e:
                 st.error(f'Index not found: {e.info}')
+            except QueueTimeout:
+                st.error('The app is very busy right now, please try again in a few minutes.')
             except Exception as e:
                 st.error(f'An unknown error occurred: {str(e)}')
 
+        elif 'search_result' in st.session_state:
+            show_results(st.session_state['search_result'])
+
         if st.button('RE-RUN APP'):
-            time.sleep(1)
\ No newline at end of file
+            st.session_state.pop('search_result', None)
+            st.rerun()
+
+
+# Batch mode: many questions with the same platforms, dates and filters in one job
+if selected_index:
+    with st.expander("Batch questions"):
+        st.markdown("Upload a text file with one question per line. All questions are searched with the "
+                    "platforms, dates and filters selected above.")
+        questions_file = st.file_uploader("Question list", type=['txt'])
+        run_batch_job = questions_file and st.button('RUN BATCH')
+        retry_after = rate_limiter.check(st.session_state.get('session_id')) if run_batch_job else 0
+        if retry_after:
+            st.warning(f'Please try again in {int(retry_after) + 1} seconds.')
+        elif run_batch_job:
+            batch_questions = read_questions(questions_file.getvalue().decode('utf-8').splitlines())
+            progress_bar = st.progress(0.0, text=f'Answering {len(batch_questions)} questions')
+            try:
+                summaries, sources = run_batch(es_config, selected_index, batch_questions, must_term, llm_chat,
+                                               prompt_template,
+                                               progress=lambda done: progress_bar.progress(
+                                                   done / len(batch_questions),
+                                                   text=f'{done}/{len(batch_questions)} questions answered'),
+                                               search_slots=search_slots, llm_slots=llm_slots)
+                st.session_state['batch_result'] = (summaries, sources)
+            except Exception as e:
+                st.error(f'Batch failed: {str(e)}')
+
+        if 'batch_result' in st.session_state:
+            summaries, sources = st.session_state['batch_result']
+            st.dataframe(summaries)
+            st.download_button('Download summaries (CSV)', summaries.to_csv(index=False), 'batch_summaries.csv',
+                               mime='text/csv')
+            st.download_button('Download sources (CSV)', sources.to_csv(index=False), 'batch_sources.csv',
+                               mime='text/csv')
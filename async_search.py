@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import threading
+
+from elasticsearch import AsyncElasticsearch
+from tenacity import AsyncRetrying
+
+from metrics import increment, observe
+from utils import (ES_CLIENT_DEFAULTS, HIT_SOURCE_FIELDS, cache_retrieval, create_knn_clause, response_size,
+                   retrieval_cache, retrieval_cache_key, retry_policy)
+
+# kNN budget per index. Telegram is by far the largest index, so it gets more candidates and time.
+# A 'k' entry caps the hits taken from that index, by default every index returns the global k.
+INDEX_BUDGETS = {
+    "ua-by-telegram": {"num_candidates": 5000, "timeout": 30},
+    "ua-by-web": {"num_candidates": 3000, "timeout": 20},
+    "ua-by-facebook": {"num_candidates": 2000, "timeout": 15},
+    "ua-by-youtube": {"num_candidates": 1000, "timeout": 15},
+}
+DEFAULT_BUDGET = {"num_candidates": 2000, "timeout": 20}
+
+_loop = None
+_loop_lock = threading.Lock()
+_clients = {}
+
+
+def get_event_loop():
+    """
+    Returns the process-wide event loop used for async searches, running in its own thread.
+    The async clients are bound to this loop, so their connection pools are shared by all sessions.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='es-async-loop', daemon=True).start()
+    return _loop
+
+
+def get_async_client(es_config):
+    """
+    Returns the AsyncElasticsearch client for the config. Has to be called on the search loop.
+    """
+    key = tuple(sorted(es_config.items()))
+    if key not in _clients:
+        settings = {**ES_CLIENT_DEFAULTS, **es_config}
+        _clients[key] = AsyncElasticsearch(f'https://{settings["host"]}:{settings["port"]}',
+                                           api_key=settings["api_key"],
+                                           connections_per_node=settings['connections_per_node'],
+                                           http_compress=settings['http_compress'],
+                                           request_timeout=settings['request_timeout'],
+                                           # retries are done in search_index, like in utils.es_call
+                                           max_retries=0)
+    return _clients[key]
+
+
+async def search_index(es_config, index, question_vector, must_term, k, source_fields):
+    """
+    Runs the kNN search on a single index within its budget.
+    """
+    budget = INDEX_BUDGETS.get(index, DEFAULT_BUDGET)
+    k = min(budget.get("k", k), k)
+    knn = create_knn_clause(question_vector, must_term, k, max(budget["num_candidates"], k))
+    es = get_async_client(es_config).options(request_timeout=budget["timeout"])
+
+    async def search():
+        async for attempt in AsyncRetrying(**retry_policy(es_config)):
+            with attempt:
+                return await es.search(index=index, size=k, knn=knn, source=source_fields)
+
+    response = await asyncio.wait_for(search(), timeout=budget["timeout"])
+    increment('es_requests')
+    increment('es_payload_bytes', response_size(response))
+    observe(f'es_took:{index}', response['took'] / 1000)
+    return response.body
+
+
+async def fan_out_search(es_config, indexes, question_vector, must_term, k, source_fields):
+    """
+    Searches all indexes concurrently and merges their hits by score into the global top k.
+    Indexes that time out or fail are left out of the result and listed under 'failed_indexes'.
+    """
+    responses = await asyncio.gather(*[search_index(es_config, index, question_vector, must_term, k, source_fields)
+                                       for index in indexes],
+                                     return_exceptions=True)
+
+    hits = []
+    failed_indexes = []
+    took = 0
+    for index, response in zip(indexes, responses):
+        if isinstance(response, BaseException):
+            logging.warning(f"kNN search on {index} failed: {type(response).__name__} {response}")
+            failed_indexes.append(index)
+        else:
+            hits.extend(response['hits']['hits'])
+            took = max(took, response['took'])
+
+    if len(failed_indexes) == len(indexes):
+        raise responses[0]
+
+    hits.sort(key=lambda hit: hit['_score'], reverse=True)
+    return {'took': took, 'hits': {'hits': hits[:k]}, 'failed_indexes': failed_indexes}
+
+
+def search_knn_per_index(es_config, selected_index, question_vector, must_term, k=30,
+                         source_fields=HIT_SOURCE_FIELDS):
+    """
+    Alternative to utils.search_knn that sends one kNN request per index, each with its own
+    num_candidates and timeout from INDEX_BUDGETS, so one slow index does not stall the search.
+    Complete results are cached in utils.retrieval_cache, partial ones are not.
+    Returns:
+        dict: A response-like dict with the merged hits, the list of failed indexes
+        and 'took' of the slowest index.
+    """
+    indexes = selected_index.split(",")
+    key = retrieval_cache_key(f"per_index:{selected_index}",
+                              create_knn_clause(question_vector, must_term, k, None), source_fields)
+    response = retrieval_cache.get(key)
+    if response is not None:
+        return response
+
+    future = asyncio.run_coroutine_threadsafe(
+        fan_out_search(es_config, indexes, question_vector, must_term, k, source_fields), get_event_loop())
+    response = future.result()
+
+    if not response['failed_indexes']:
+        cache_retrieval(key, response, must_term)
+
+    return response
@@ -1,4 +1,5 @@
 import hmac
+import uuid
 import streamlit as st
 
 # code from https://docs.streamlit.io/knowledge-base/deploy/authentication-without-sso
@@ -8,6 +9,8 @@ def check_password():
     def password_entered():
         if hmac.compare_digest(st.session_state["password"], st.secrets['ld_rag']["password"]):
             st.session_state["password_correct"] = True
+            # identifies the logged in session, e.g. for rate limits
+            st.session_state["session_id"] = uuid.uuid4().hex
             del st.session_state["password"]
         else:
             st.session_state["password_correct"] = False
@@ -0,0 +1,200 @@
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+import pandas as pd
+
+from context import pack_context, format_urls
+from embeddings import encode_questions
+from metrics import increment, observe, timed
+from utils import (es_call, create_knn_clause, create_must_term, populate_terms, create_dataframe_from_response,
+                   HIT_SOURCE_FIELDS)
+
+# Number of kNN searches sent in one _msearch request
+MSEARCH_CHUNK_SIZE = 20
+# Number of summaries generated at the same time
+BATCH_LLM_CONCURRENCY = 4
+OUTPUT_FORMATS = ('csv', 'parquet')
+
+
+def read_questions(lines):
+    """
+    Returns the non-empty lines of a question list, without duplicates, in their original order.
+    """
+    questions = []
+    for line in lines:
+        question = line.strip()
+        if question and question not in questions:
+            questions.append(question)
+    return questions
+
+
+def msearch_knn(es_config, selected_index, question_vectors, must_term, k=30, num_candidates=10000,
+                chunk_size=MSEARCH_CHUNK_SIZE, source_fields=HIT_SOURCE_FIELDS):
+    """
+    Runs one kNN search per question vector, chunk_size searches per _msearch request.
+    Returns:
+        list: One response per vector; a failed search gives a dict with an 'error' key instead.
+    """
+    header = {"index": selected_index}
+    responses = []
+    for start in range(0, len(question_vectors), chunk_size):
+        searches = []
+        for question_vector in question_vectors[start:start + chunk_size]:
+            searches.append(header)
+            searches.append({"size": k, "knn": create_knn_clause(question_vector, must_term, k, num_candidates),
+                             "_source": source_fields})
+        with timed('es_msearch'):
+            chunk = es_call(es_config, 'msearch', searches=searches)['responses']
+        for response in chunk:
+            if 'took' in response:
+                observe('es_took', response['took'] / 1000)
+        responses.extend(chunk)
+    return responses
+
+
+def summarize(llm_chat, prompt_template, question, response):
+    """
+    Generates the summary for one question from its kNN response.
+    Returns:
+        tuple: The answer and the LangSmith run id.
+    """
+    from langchain import callbacks
+
+    texts_list = format_urls(pack_context(response['hits']['hits']))
+    messages = prompt_template.format_messages(question=question, texts=texts_list)
+    with callbacks.collect_runs() as cb, timed('llm_total'):
+        answer = llm_chat.invoke(messages).content
+    run_id = cb.traced_runs[0].id if cb.traced_runs else None
+    return answer, run_id
+
+
+def run_batch(es_config, selected_index, questions, must_term, llm_chat, prompt_template, max_doc_num=30,
+              concurrency=BATCH_LLM_CONCURRENCY, progress=None, search_slots=None, llm_slots=None):
+    """
+    Answers a list of questions over the same indexes and filters.
+    All questions are encoded in one model call, the kNN searches are sent with _msearch and
+    up to `concurrency` summaries are generated at the same time.
+    progress, if given, is called with the number of finished summaries.
+    search_slots and llm_slots (admission.AdmissionController) share the app's limits on concurrent
+    searches and LLM calls with the batch.
+    Returns:
+        tuple: The summaries DataFrame (one row per question) and the sources DataFrame
+        (the create_dataframe_from_response tables of all questions, with a question column).
+    """
+    start_time = time.time()
+    question_vectors = encode_questions(questions)
+    with search_slots.slot() if search_slots else nullcontext():
+        responses = msearch_knn(es_config, selected_index, question_vectors, must_term, k=max_doc_num)
+
+    def answer(question, response):
+        if 'error' in response:
+            return None, None, str(response['error'])
+        try:
+            with llm_slots.slot() if llm_slots else nullcontext():
+                return (*summarize(llm_chat, prompt_template, question, response), None)
+        except Exception as e:
+            logging.error(f"Summary failed for question {question!r}: {e}")
+            return None, None, str(e)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch-llm') as executor:
+        futures = [executor.submit(answer, question, response) for question, response in zip(questions, responses)]
+        for done, future in enumerate(futures, start=1):
+            results.append(future.result())
+            if progress:
+                progress(done)
+
+    summaries = pd.DataFrame({
+        'question': questions,
+        'answer': [answer for answer, _, _ in results],
+        'run_id': [str(run_id) if run_id else None for _, run_id, _ in results],
+        'num_sources': [len(response['hits']['hits']) if 'hits' in response else 0 for response in responses],
+        'error': [error for _, _, error in results],
+    })
+
+    tables = []
+    for question, response in zip(questions, responses):
+        df = create_dataframe_from_response(response)
+        if not df.empty:
+            df.insert(0, 'question', question)
+            tables.append(df)
+    sources = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+    increment('batch_questions', len(questions))
+    observe('batch_total', time.time() - start_time)
+    logging.info(f"Answered {len(questions)} questions in {time.time() - start_time:.1f} s")
+    return summaries, sources
+
+
+def write_outputs(summaries, sources, output_prefix, fmt='csv'):
+    """
+    Writes the summaries and sources tables to <output_prefix>_summaries.<fmt> and <output_prefix>_sources.<fmt>.
+    Returns:
+        list: The written paths.
+    """
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {fmt!r}, expected one of {OUTPUT_FORMATS}")
+    paths = []
+    for name, df in (('summaries', summaries), ('sources', sources)):
+        path = f'{output_prefix}_{name}.{fmt}'
+        if fmt == 'csv':
+            df.to_csv(path, index=False)
+        else:
+            df.to_parquet(path, index=False)
+        paths.append(path)
+    return paths
+
+
+if __name__ == '__main__':
+    import streamlit as st
+
+    from embeddings import set_backend
+    from llm import create_chat_model, load_prompt, PROMPT_NAME
+
+    parser = argparse.ArgumentParser(description='Answers a list of questions (one per line) in one batch job. '
+                                                 'Settings are read from .streamlit/secrets.toml.')
+    parser.add_argument('questions', help='text file with one question per line')
+    parser.add_argument('--index', required=True, help='comma separated index names')
+    parser.add_argument('--start-date', required=True, help='YYYY-MM-DD')
+    parser.add_argument('--end-date', required=True, help='YYYY-MM-DD')
+    parser.add_argument('--category', nargs='*', help='category filter values')
+    parser.add_argument('--language', nargs='*', help='language filter values')
+    parser.add_argument('--country', nargs='*', help='country filter values')
+    parser.add_argument('--max-doc-num', type=int, default=30)
+    parser.add_argument('--concurrency', type=int, default=BATCH_LLM_CONCURRENCY)
+    parser.add_argument('--output', default='batch', help='output path prefix')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='csv')
+    args = parser.parse_args()
+
+    secrets = st.secrets['ld_rag']
+    os.environ["LANGCHAIN_TRACING_V2"] = "true"
+    os.environ["LANGCHAIN_PROJECT"] = f"rag_app : summarization : production : uaby_batch"
+    os.environ["LANGCHAIN_ENDPOINT"] = "https://api.smith.langchain.com"
+    os.environ["LANGCHAIN_API_KEY"] = secrets['LANGCHAIN_API_KEY']
+    es_config = {
+        'host': secrets['ELASTIC_HOST'],
+        'port': secrets['ELASTIC_PORT'],
+        'api_key': secrets['ELASTIC_API']
+    }
+    set_backend(secrets.get('ENCODER_BACKEND', 'fp32'))
+
+    with open(args.questions, 'r') as file:
+        questions = read_questions(file)
+
+    must_term = create_must_term(populate_terms(args.category, 'category.keyword'),
+                                 populate_terms(args.language, 'language.keyword'),
+                                 populate_terms(args.country, 'country.keyword'),
+                                 formatted_start_date=args.start_date,
+                                 formatted_end_date=args.end_date)
+
+    summaries, sources = run_batch(es_config, args.index, questions, must_term,
+                                   create_chat_model(secrets['OPENAI_KEY_ORG']),
+                                   load_prompt(f'{secrets["LANGSMITH_ACC"]}/{PROMPT_NAME}'),
+                                   max_doc_num=args.max_doc_num, concurrency=args.concurrency,
+                                   progress=lambda done: print(f'{done}/{len(questions)} questions answered'))
+    for path in write_outputs(summaries, sources, args.output, args.format):
+        print(f'Wrote {path}')
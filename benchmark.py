@@ -0,0 +1,416 @@
+"""
+Offline benchmark of the RUN SEARCH flow.
+
+Questions are replayed through pipeline.answer_question, the same RUN SEARCH flow app.py runs (debounced
+embedding, admission slots, single-flight kNN search, answer cache, prompt formatting, LLM streaming, dataframe
+and chart data), but Elasticsearch is replaced by an in-process brute-force kNN over synthetic vectors and the chat
+model by a deterministic fake. No network or secrets needed.
+
+    python benchmark.py --sessions 4 --questions 40 --output bench.json
+    python benchmark.py --save-baseline benchmark_baseline.json
+    python benchmark.py --baseline benchmark_baseline.json
+"""
+import argparse
+import hashlib
+import json
+import random
+import resource
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import embeddings
+import utils
+from admission import MAX_CONCURRENT_LLM_CALLS, MAX_CONCURRENT_SEARCHES, AdmissionController, SingleFlight
+from embeddings import QuestionDebouncer
+from llm import AnswerCache
+from metrics import Trace
+from pipeline import answer_question
+from utils import (CATEGORICAL_COLUMNS, count_values, create_must_term, populate_default_values, populate_terms,
+                   project_indexes)
+
+DIMENSIONS = 1024
+STAGES = ['facet_loading', 'encode_wait', 'es_search', 'prompt_format', 'llm_first_token', 'llm_total',
+          'dataframe_build', 'chart_render', 'total']
+REGRESSION_TOLERANCE = 0.2
+# p95 changes smaller than this are treated as noise
+MIN_REGRESSION_MS = 10
+
+CATEGORIES = ['media', 'politician', 'activist', 'blogger', 'official']
+LANGUAGES = ['en', 'ru', 'uk', 'be']
+COUNTRIES = ['BY', 'UA', 'RU', 'PL', 'LT']
+WORDS = ('army border minsk kyiv election protest sanctions energy grain drone missile refugee court '
+         'opposition prison railway exercise troops statement minister report attack aid').split()
+
+
+class FakeResponse:
+    """
+    Response object with the parts of ObjectApiResponse used by the app.
+    """
+
+    class Meta:
+        def __init__(self, headers):
+            self.headers = headers
+
+    def __init__(self, body):
+        self.body = body
+        self.meta = self.Meta({'content-length': str(len(json.dumps(body)))})
+
+    def __getitem__(self, key):
+        return self.body[key]
+
+    def get(self, key, default=None):
+        return self.body.get(key, default)
+
+
+class FakeElasticsearch:
+    """
+    In-process stand-in for the Elasticsearch client: exact kNN with NumPy over synthetic documents.
+    Supports the filters built by create_must_term (range, term, bool must/should/must_not) and terms aggregations.
+    """
+
+    def __init__(self, num_docs, seed=0, latency=0.0):
+        rng = np.random.default_rng(seed)
+        self.latency = latency
+        self.indexes = np.array(rng.choice(project_indexes['ua-by'], num_docs, p=[0.5, 0.3, 0.15, 0.05]))
+        vectors = rng.standard_normal((num_docs, DIMENSIONS), dtype=np.float32)
+        self.vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        days = rng.integers(0, 60, num_docs)
+        self.fields = {
+            'date': np.array([f'2024-{1 + day // 30:02d}-{1 + day % 30:02d}' for day in days]),
+            'category': rng.choice(CATEGORIES, num_docs),
+            'language': rng.choice(LANGUAGES, num_docs),
+            'country': rng.choice(COUNTRIES, num_docs),
+            'type': rng.choice(['post', 'comment'], num_docs, p=[0.8, 0.2]),
+        }
+        word_ids = rng.integers(0, len(WORDS), (num_docs, 60))
+        texts = [' '.join(WORDS[i] for i in row) for row in word_ids]
+        # every tenth document is a repost of the one before it
+        for i in range(1, num_docs, 10):
+            texts[i] = 'Repost: ' + texts[i - 1]
+        self.fields['translated_text'] = np.array(texts, dtype=object)
+        self.fields['text'] = self.fields['translated_text']
+        self.fields['url'] = np.array([f't.me/channel/{i}' for i in range(num_docs)], dtype=object)
+
+    def options(self, **kwargs):
+        return self
+
+    def _field(self, name):
+        return self.fields[name.removesuffix('.keyword')]
+
+    def _mask(self, clause):
+        if 'range' in clause:
+            (field, bounds), = clause['range'].items()
+            values = self._field(field)
+            mask = np.ones(len(values), dtype=bool)
+            if 'gte' in bounds:
+                mask &= values >= bounds['gte']
+            if 'lte' in bounds:
+                mask &= values <= bounds['lte']
+            return mask
+        if 'term' in clause:
+            (field, value), = clause['term'].items()
+            return self._field(field) == value
+        if 'bool' in clause:
+            query = clause['bool']
+            mask = np.ones(len(self.indexes), dtype=bool)
+            for sub in query.get('must', []):
+                mask &= self._mask(sub)
+            for sub in query.get('must_not', []):
+                mask &= ~self._mask(sub)
+            if query.get('should'):
+                should = np.zeros(len(self.indexes), dtype=bool)
+                for sub in query['should']:
+                    should |= self._mask(sub)
+                mask &= should
+            return mask
+        raise ValueError(f'Unsupported query clause {clause}')
+
+    def _index_mask(self, index):
+        return np.isin(self.indexes, index.split(','))
+
+    def _hit(self, i, score, source):
+        fields = source if source is not None else [f for f in self.fields if f != 'type']
+        return {'_index': self.indexes[i], '_id': str(i), '_score': score,
+                '_source': {field: self.fields[field][i] for field in fields}, 'sort': [score, int(i)]}
+
+    def search(self, index=None, size=10, knn=None, source=None, aggs=None, pit=None, search_after=None,
+               **kwargs):
+        start = time.perf_counter()
+        if pit is not None:
+            index = pit['id']
+        mask = self._index_mask(index)
+
+        hits = []
+        if knn is not None:
+            if 'filter' in knn:
+                mask &= self._mask(knn['filter'])
+            candidates = np.flatnonzero(mask)
+            query = np.asarray(knn['query_vector'], dtype=np.float32)
+            query = query / np.linalg.norm(query)
+            # cosine similarity, scaled like Elasticsearch does for the 'cosine' similarity
+            scores = (1 + self.vectors[candidates] @ query) / 2
+            if 'similarity' in knn:
+                # 'similarity' is the raw cosine similarity, not the scaled score
+                keep = 2 * scores - 1 >= knn['similarity']
+                candidates, scores = candidates[keep], scores[keep]
+            order = np.argsort(-scores, kind='stable')[:knn['k']]
+            ranked = [(float(scores[j]), int(candidates[j])) for j in order]
+            if search_after:
+                ranked = [hit for hit in ranked if (hit[0], -hit[1]) < (search_after[0], -search_after[1])]
+            hits = [self._hit(i, score, source) for score, i in ranked[:size]]
+
+        body = {'took': 0, 'timed_out': False, 'hits': {'hits': hits}}
+        if pit is not None:
+            body['pit_id'] = pit['id']
+        if aggs:
+            body['aggregations'] = {}
+            for name, agg in aggs.items():
+                values, counts = np.unique(self._field(agg['terms']['field'])[mask], return_counts=True)
+                order = np.argsort(-counts)[:agg['terms'].get('size', 10)]
+                body['aggregations'][name] = {'buckets': [{'key': str(values[j]), 'doc_count': int(counts[j])}
+                                                          for j in order]}
+
+        time.sleep(self.latency)
+        body['took'] = int((time.perf_counter() - start) * 1000)
+        return FakeResponse(body)
+
+    def msearch(self, searches, **kwargs):
+        responses = []
+        for header, body in zip(searches[::2], searches[1::2]):
+            try:
+                responses.append(self.search(index=header['index'], size=body.get('size', 10), knn=body.get('knn'),
+                                             source=body.get('_source')).body)
+            except (ValueError, KeyError) as e:
+                responses.append({'error': {'type': 'unsupported', 'reason': str(e)}, 'status': 400})
+        return FakeResponse({'took': 0, 'responses': responses})
+
+    def open_point_in_time(self, index, keep_alive):
+        return FakeResponse({'id': index})
+
+    def close_point_in_time(self, id):
+        return FakeResponse({'succeeded': True})
+
+
+class FakeChunk:
+    def __init__(self, content):
+        self.content = content
+
+
+class FakeChatModel:
+    """
+    Deterministic stand-in for the chat model: the answer depends only on the messages,
+    and is streamed with a fixed time to first token and per-chunk delay.
+    """
+
+    def __init__(self, first_token_delay=0.3, chunk_delay=0.005, num_chunks=150):
+        self.first_token_delay = first_token_delay
+        self.chunk_delay = chunk_delay
+        self.num_chunks = num_chunks
+
+    def stream(self, messages):
+        digest = hashlib.sha256(str(messages).encode()).hexdigest()
+        time.sleep(self.first_token_delay)
+        for i in range(self.num_chunks):
+            yield FakeChunk(f'{WORDS[int(digest[i % 64], 16)]} ')
+            time.sleep(self.chunk_delay)
+
+    def invoke(self, messages):
+        return FakeChunk(''.join(chunk.content for chunk in self.stream(messages)))
+
+
+class FakeEncoder:
+    """
+    Deterministic stand-in for AnglE: a pseudo-random unit vector per text, with a fixed cost per batch.
+    """
+
+    def __init__(self, batch_delay=0.05):
+        self.batch_delay = batch_delay
+
+    def encode(self, inputs, to_numpy=True, prompt=None):
+        inputs = inputs if isinstance(inputs, list) else [inputs]
+        time.sleep(self.batch_delay)
+        vectors = []
+        for item in inputs:
+            seed = int(hashlib.sha256(item['text'].encode()).hexdigest()[:8], 16)
+            vectors.append(np.random.default_rng(seed).standard_normal(DIMENSIONS, dtype=np.float32))
+        return np.array(vectors)
+
+
+def create_prompt_template():
+    """
+    Local copy of the summarization prompt shape, so the benchmark does not need the LangChain hub.
+    """
+    from langchain_core.prompts import ChatPromptTemplate
+    return ChatPromptTemplate.from_messages([
+        ('system', 'Answer the question using only the provided texts and cite their urls.'),
+        ('human', 'Question: {question}\nTexts: {texts}'),
+    ])
+
+
+def synthetic_questions(count, seed=0):
+    rng = random.Random(seed)
+    return [f'What happened with {rng.choice(WORDS)} and {rng.choice(WORDS)} near {rng.choice(WORDS)}?'
+            for _ in range(count)]
+
+
+def random_filters(rng):
+    """
+    Returns (selected_index, must_term) similar to what an analyst would pick in the app.
+    """
+    indexes = rng.sample(project_indexes['ua-by'], rng.randint(1, 4))
+    categories = rng.choice([['Any'], rng.sample(CATEGORIES, 2)])
+    languages = rng.choice([['Any'], ['en']])
+    must_term = create_must_term(populate_terms(categories, 'category.keyword'),
+                                 populate_terms(languages, 'language.keyword'),
+                                 populate_terms(['Any'], 'country.keyword'),
+                                 formatted_start_date='2024-01-01', formatted_end_date='2024-01-15')
+    return ",".join(indexes), must_term
+
+
+def run_question(question, es_config, selected_index, must_term, llm_chat, prompt_template, answer_cache, admission,
+                 max_doc_num=30):
+    """
+    Runs one question through pipeline.answer_question, the RUN SEARCH flow of app.py, and returns its Trace.
+    admission is the (search_slots, llm_slots, search_flights, answer_flights) tuple shared by all sessions.
+    """
+    trace = Trace(index=selected_index, fan_out=False, retrieval_mode='knn')
+    start = time.perf_counter()
+
+    with trace.span('facet_loading'):
+        populate_default_values(selected_index, es_config)
+    question_debouncer = QuestionDebouncer()
+    question_debouncer.update(question)
+
+    def count_chart_values(df):
+        for column in CATEGORICAL_COLUMNS:
+            if column in df.columns:
+                count_values(df[column], column)
+
+    answer_question(es_config, selected_index, question, question_debouncer, must_term, llm_chat, prompt_template,
+                    answer_cache, *admission, trace, max_doc_num=max_doc_num, render_sources=count_chart_values,
+                    replay_delay=0)
+
+    trace.record('total', time.perf_counter() - start)
+    return trace
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_benchmark(questions, sessions, num_docs, llm_chat, seed=0, es_latency=0.0):
+    """
+    Replays the questions from the given number of concurrent sessions.
+    Returns:
+        dict: Percentiles per stage (ms), throughput (questions/s) and peak RSS (MB).
+    """
+    fake_es = FakeElasticsearch(num_docs, seed=seed, latency=es_latency)
+    utils.get_es_client = lambda es_config: fake_es
+    utils.retrieval_cache.clear()
+    utils.clear_default_values_cache()
+    embeddings._model = FakeEncoder()
+    embeddings._model_ready.set()
+    embeddings.init_vector_cache().clear()
+
+    es_config = {'host': 'localhost', 'port': 9200, 'api_key': 'benchmark'}
+    prompt_template = create_prompt_template()
+    answer_cache = AnswerCache()
+    admission = (AdmissionController(MAX_CONCURRENT_SEARCHES, 'search'),
+                 AdmissionController(MAX_CONCURRENT_LLM_CALLS, 'llm'), SingleFlight(), SingleFlight())
+    rng = random.Random(seed)
+    jobs = [(question, *random_filters(rng)) for question in questions]
+    lock = threading.Lock()
+    traces = []
+
+    def run_session(session_jobs):
+        for question, selected_index, must_term in session_jobs:
+            trace = run_question(question, es_config, selected_index, must_term, llm_chat, prompt_template,
+                                 answer_cache, admission)
+            with lock:
+                traces.append(trace)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(sessions) as executor:
+        list(executor.map(run_session, [jobs[i::sessions] for i in range(sessions)]))
+    wall_time = time.perf_counter() - start
+
+    stages = {}
+    for stage in STAGES:
+        values = [trace.spans[stage] * 1000 for trace in traces if stage in trace.spans]
+        if values:
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            stages[stage] = {'p50': round(p50, 2), 'p95': round(p95, 2), 'p99': round(p99, 2), 'n': len(values)}
+
+    return {
+        'sessions': sessions,
+        'questions': len(questions),
+        'documents': num_docs,
+        'throughput': round(len(questions) / wall_time, 3),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'stages': stages,
+    }
+
+
+def compare_to_baseline(result, baseline, tolerance=REGRESSION_TOLERANCE):
+    """
+    Returns the list of regressions: stages whose p95 grew, or throughput that dropped, by more than tolerance.
+    Stages whose p95 grew by less than MIN_REGRESSION_MS are ignored.
+    """
+    regressions = []
+    for stage, current in result['stages'].items():
+        previous = baseline['stages'].get(stage)
+        if (previous and current['p95'] > previous['p95'] * (1 + tolerance)
+                and current['p95'] - previous['p95'] > MIN_REGRESSION_MS):
+            regressions.append(f"{stage} p95 {previous['p95']} ms -> {current['p95']} ms")
+    if result['throughput'] < baseline['throughput'] * (1 - tolerance):
+        regressions.append(f"throughput {baseline['throughput']} -> {result['throughput']} questions/s")
+    return regressions
+
+
+def print_report(result):
+    print(f"{result['questions']} questions, {result['sessions']} sessions, {result['documents']} documents")
+    print(f"{'stage':<18}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, values in result['stages'].items():
+        print(f"{stage:<18}{values['p50']:>10}{values['p95']:>10}{values['p99']:>10}")
+    print(f"throughput {result['throughput']} questions/s, peak RSS {result['peak_rss_mb']} MB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmark of the RUN SEARCH flow.')
+    parser.add_argument('--questions', type=int, default=40, help='Number of synthetic questions')
+    parser.add_argument('--questions-file', help='Text file with one question per line, replaces synthetic ones')
+    parser.add_argument('--sessions', type=int, default=4, help='Concurrent sessions')
+    parser.add_argument('--docs', type=int, default=20000, help='Synthetic documents in the fake index')
+    parser.add_argument('--es-latency', type=float, default=0.0, help='Added latency per ES request (s)')
+    parser.add_argument('--llm-first-token', type=float, default=0.3, help='Fake LLM time to first token (s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the result as JSON')
+    parser.add_argument('--baseline', help='Compare against this stored result, exit 1 on regression')
+    parser.add_argument('--save-baseline', help='Store the result as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE)
+    args = parser.parse_args()
+
+    if args.questions_file:
+        with open(args.questions_file, 'r') as file:
+            question_set = [line.strip() for line in file if line.strip()]
+    else:
+        question_set = synthetic_questions(args.questions, seed=args.seed)
+
+    result = run_benchmark(question_set, args.sessions, args.docs,
+                           FakeChatModel(first_token_delay=args.llm_first_token),
+                           seed=args.seed, es_latency=args.es_latency)
+    print_report(result)
+
+    for path in filter(None, [args.output, args.save_baseline]):
+        with open(path, 'w') as file:
+            json.dump(result, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            found = compare_to_baseline(result, json.load(file), args.tolerance)
+        for regression in found:
+            print(f'REGRESSION: {regression}')
+        raise SystemExit(1 if found else 0)
@@ -0,0 +1,158 @@
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class SqliteStore:
+    """
+    Small on-disk key/value store backed by sqlite, used to persist caches across restarts.
+    Values are pickled. Rows past maxsize are dropped, least recently used first.
+    """
+
+    def __init__(self, path, table='cache', maxsize=100000):
+        self.table = table
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(f'CREATE TABLE IF NOT EXISTS {table} '
+                               f'(key TEXT PRIMARY KEY, value BLOB, expires_at REAL, accessed_at REAL)')
+
+    def get(self, key):
+        """
+        Returns (value, expires_at) for the key, or None if it is missing or expired.
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute(f'SELECT value, expires_at FROM {self.table} WHERE key = ?',
+                                     (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] is not None and row[1] < time.time():
+                self._conn.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+                return None
+            self._conn.execute(f'UPDATE {self.table} SET accessed_at = ? WHERE key = ?', (time.time(), key))
+        return pickle.loads(row[0]), row[1]
+
+    def set(self, key, value, expires_at=None):
+        with self._lock, self._conn:
+            self._conn.execute(f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?)',
+                               (key, pickle.dumps(value), expires_at, time.time()))
+            self._conn.execute(f'DELETE FROM {self.table} WHERE key IN '
+                               f'(SELECT key FROM {self.table} ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                               (self.maxsize,))
+
+    def items(self, limit=None):
+        """
+        Returns (key, value, expires_at) for the entries that have not expired, most recently used first.
+        With limit, only that many entries are read.
+        """
+        with self._lock:
+            rows = self._conn.execute(f'SELECT key, value, expires_at FROM {self.table} '
+                                      f'WHERE expires_at IS NULL OR expires_at >= ? '
+                                      f'ORDER BY accessed_at DESC LIMIT ?',
+                                      (time.time(), -1 if limit is None else limit)).fetchall()
+        return [(key, pickle.loads(value), expires_at) for key, value, expires_at in rows]
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute(f'DELETE FROM {self.table}')
+
+
+class LRUCache:
+    """
+    Thread-safe in-memory cache with LRU eviction and optional per-entry TTL.
+    If a store is given, entries are written through to it and read back on a memory miss.
+    on_evict, if given, is called with the key of every entry dropped from memory (evicted or expired).
+    """
+
+    def __init__(self, maxsize, ttl=None, store=None, on_evict=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.store = store
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (entry[1] is None or entry[1] >= time.time()):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            expired = [key] if self._data.pop(key, None) is not None else []
+        self._evicted(expired)
+
+        stored = self.store.get(key) if self.store is not None else None
+        with self._lock:
+            if stored is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            evicted = self._put(key, stored[0], stored[1])
+        self._evicted(evicted)
+        return stored[0]
+
+    def set(self, key, value, ttl=None):
+        """
+        Adds an entry. ttl (seconds) overrides the cache default for this entry.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            evicted = self._put(key, value, expires_at)
+        self._evicted(evicted)
+        if self.store is not None:
+            self.store.set(key, value, expires_at)
+
+    def warm(self):
+        """
+        Loads the most recently used entries of the store into memory, up to maxsize.
+        Returns:
+            list: The loaded (key, value) pairs.
+        """
+        if self.store is None:
+            return []
+        rows = self.store.items(limit=self.maxsize)
+        with self._lock:
+            # oldest first, so the LRU order matches the store
+            for key, value, expires_at in reversed(rows):
+                self._put(key, value, expires_at)
+        return [(key, value) for key, value, _ in rows]
+
+    def _put(self, key, value, expires_at):
+        """
+        Adds an entry while holding the lock. Returns the keys evicted to make room.
+        """
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        evicted = []
+        while len(self._data) > self.maxsize:
+            evicted.append(self._data.popitem(last=False)[0])
+        return evicted
+
+    def _evicted(self, keys):
+        # called without the lock held, so the callback may use the cache
+        if self.on_evict is not None:
+            for key in keys:
+                self.on_evict(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+        if self.store is not None:
+            self.store.clear()
+
+    def stats(self):
+        """
+        Returns hit/miss counters and the current number of in-memory entries.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+    def __len__(self):
+        return len(self._data)
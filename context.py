@@ -0,0 +1,107 @@
+import logging
+
+# Limits for the texts passed to the summarization prompt
+MAX_CONTEXT_TOKENS = 8000
+MAX_PASSAGE_TOKENS = 800
+# Texts sharing this much of their word shingles are treated as reposts of each other
+DUPLICATE_THRESHOLD = 0.7
+SHINGLE_SIZE = 5
+
+_encoding = None
+
+
+def get_encoding():
+    """
+    Returns the tiktoken encoding of the chat model, or None if it is not available.
+    """
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding('cl100k_base')
+        except Exception as e:
+            # not installed, or the encoding file could not be downloaded
+            logging.warning(f"tiktoken is not available, token counts are estimated: {e}")
+            _encoding = False
+    return _encoding or None
+
+
+def count_tokens(text):
+    encoding = get_encoding()
+    return len(encoding.encode(text)) if encoding else len(text) // 4
+
+
+def truncate_to_tokens(text, max_tokens):
+    """
+    Cuts the text down to max_tokens tokens.
+    """
+    encoding = get_encoding()
+    if encoding:
+        tokens = encoding.encode(text)
+        return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+    return text[:max_tokens * 4]
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    """
+    Returns the set of hashed word n-grams of the text.
+    """
+    words = text.lower().split()
+    if len(words) <= size:
+        return {hash(" ".join(words))}
+    return {hash(" ".join(words[i:i + size])) for i in range(len(words) - size + 1)}
+
+
+def is_near_duplicate(candidate, kept, threshold=DUPLICATE_THRESHOLD):
+    """
+    Checks if the candidate shingle set overlaps any of the kept sets by at least the threshold
+    (measured against the smaller set, so a repost with a short comment added still matches).
+    """
+    for other in kept:
+        overlap = len(candidate & other) / max(min(len(candidate), len(other)), 1)
+        if overlap >= threshold:
+            return True
+    return False
+
+
+def format_urls(texts_list):
+    """
+    Adds https:// to urls without a scheme, so they work properly as links.
+    """
+    return [(text, 'https://' + url if not url.startswith('http://') and not url.startswith('https://') else url)
+            for text, url in texts_list]
+
+
+def pack_context(hits, max_tokens=MAX_CONTEXT_TOKENS, max_passage_tokens=MAX_PASSAGE_TOKENS,
+                 threshold=DUPLICATE_THRESHOLD):
+    """
+    Selects the texts for the summarization prompt from the retrieved hits.
+    Hits are taken by score, near-duplicates of better hits are dropped, long texts are truncated
+    to max_passage_tokens, and packing stops once max_tokens is reached.
+    Returns:
+        list: (translated_text, url) tuples.
+    """
+    texts_list = []
+    kept_shingles = []
+    used_tokens = 0
+
+    for hit in sorted(hits, key=lambda hit: hit.get('_score') or 0, reverse=True):
+        text = hit['_source'].get('translated_text') or ''
+        if not text.strip():
+            continue
+
+        text_shingles = shingles(text)
+        if is_near_duplicate(text_shingles, kept_shingles, threshold):
+            continue
+
+        text = truncate_to_tokens(text, max_passage_tokens)
+        tokens = count_tokens(text)
+        if used_tokens + tokens > max_tokens:
+            continue
+
+        kept_shingles.append(text_shingles)
+        texts_list.append((text, hit['_source']['url']))
+        used_tokens += tokens
+
+    logging.info(f"Packed {len(texts_list)} of {len(hits)} texts into {used_tokens} tokens")
+    return texts_list
@@ -0,0 +1,334 @@
+import argparse
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from caching import LRUCache, SqliteStore
+from metrics import increment, timed
+
+MODEL_NAME = 'WhereIsAI/UAE-Large-V1'
+# angle_emb Prompts.C, kept here so the prompt is known without importing torch
+QUESTION_PROMPT = 'Represent this sentence for searching relevant passages: {text}'
+
+# 'fp32' is the reference model, 'int8' uses dynamic quantization of the linear layers (CPU only)
+ENCODER_BACKENDS = ('fp32', 'int8')
+PARITY_TOLERANCE = 0.99  # minimal cosine similarity to the fp32 vectors
+
+VECTOR_CACHE_SIZE = 2048
+
+# Micro-batching of questions from all sessions
+MAX_BATCH_SIZE = 16
+MAX_BATCH_WAIT = 0.02  # seconds
+ENCODE_TIMEOUT = 300  # seconds, covers the model load after a restart
+QUESTION_DEBOUNCE = 0.5  # seconds a question has to stay unchanged before it is encoded
+
+_backend = 'fp32'
+_model = None
+_model_lock = threading.Lock()
+_model_ready = threading.Event()
+_preload_thread = None
+_preload_lock = threading.Lock()
+
+_vector_cache = None
+_vector_cache_lock = threading.Lock()
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def set_backend(backend):
+    """
+    Selects the inference backend. Has to be called before the model is loaded.
+    """
+    global _backend
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f"Unknown encoder backend {backend}, expected one of {', '.join(ENCODER_BACKENDS)}")
+    with _model_lock:
+        if _model is not None and backend != _backend:
+            logging.warning(f"Encoder already loaded with the {_backend} backend, ignoring {backend}")
+            return
+        _backend = backend
+
+
+def build_model(backend):
+    """
+    Loads a new instance of the question encoder for the given backend.
+    """
+    from angle_emb import AnglE
+    model = AnglE.from_pretrained(MODEL_NAME, pooling_strategy='cls')
+    if backend == 'int8':
+        import torch
+        model.backbone = torch.quantization.quantize_dynamic(model.backbone, {torch.nn.Linear}, dtype=torch.qint8)
+        model.backbone.eval()
+    return model
+
+
+def load_model():
+    """
+    Loads the question encoder once per process and returns it.
+    Other callers block until the model is ready.
+    """
+    global _model
+    with _model_lock:
+        if _model is None:
+            logging.info(f"Loading {MODEL_NAME} ({_backend})")
+            with timed('model_load'):
+                _model = build_model(_backend)
+            _model_ready.set()
+    return _model
+
+
+def start_preload():
+    """
+    Starts loading the model in a background thread, so the first question does not pay for it.
+    Safe to call on every script run, the model is only loaded once.
+    """
+    global _preload_thread
+    with _preload_lock:
+        if _preload_thread is None:
+            _preload_thread = threading.Thread(target=load_model, name='model-preload', daemon=True)
+            _preload_thread.start()
+
+
+def is_model_ready():
+    """
+    Returns True once the model is loaded and questions can be encoded without waiting for it.
+    """
+    return _model_ready.is_set()
+
+
+def init_vector_cache(maxsize=VECTOR_CACHE_SIZE, path=None):
+    """
+    Creates the process-wide question vector cache.
+    If path is given, vectors are also kept in a sqlite file there and survive restarts.
+    """
+    global _vector_cache
+    with _vector_cache_lock:
+        if _vector_cache is None:
+            store = SqliteStore(path, table='question_vectors') if path else None
+            _vector_cache = LRUCache(maxsize, store=store)
+    return _vector_cache
+
+
+def normalize_question(question):
+    """
+    Collapses whitespace, so trivially different spellings of a question share a cache entry.
+    """
+    return " ".join(question.split())
+
+
+class EmbeddingBatcher:
+    """
+    Encodes questions from all sessions in a single worker thread.
+    Pending questions are collected for up to max_wait seconds (or max_batch_size questions)
+    and encoded with one model call, which is much faster on CPU than one call per question.
+    """
+
+    def __init__(self, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_BATCH_WAIT):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='embedding-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, text):
+        """
+        Queues a text for encoding and returns a Future with its vector (list of floats).
+        Use asyncio.wrap_future to await it from a coroutine.
+        """
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            texts = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                with timed('encode_batch'):
+                    vectors = encode_batch(texts)
+                increment('encoded_questions', len(texts))
+            except Exception as e:
+                logging.error(f"Error encoding a batch of {len(texts)} questions: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            vectors_by_text = dict(zip(texts, vectors))
+            for text, future in batch:
+                future.set_result(vectors_by_text[text])
+
+
+def get_batcher():
+    """
+    Returns the process-wide embedding batcher, starting it on first use.
+    """
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None:
+            _batcher = EmbeddingBatcher()
+    return _batcher
+
+
+def encode_batch(texts):
+    """
+    Encodes already normalized texts with one model call. Returns a list of vectors.
+    """
+    vec = load_model().encode([{'text': text} for text in texts], to_numpy=True, prompt=QUESTION_PROMPT)
+    return vec.tolist()
+
+
+def _cache_key(question):
+    return f'{_backend}\n{QUESTION_PROMPT}\n{question}'
+
+
+def submit_question(question):
+    """
+    Returns a Future with the embedding of the question.
+    Cached vectors are returned right away, others are encoded by the batcher and then cached.
+    """
+    cache = init_vector_cache()
+    question = normalize_question(question)
+    key = _cache_key(question)
+
+    question_vector = cache.get(key)
+    if question_vector is not None:
+        future = Future()
+        future.set_result(question_vector)
+        return future
+
+    def cache_vector(done):
+        if done.exception() is None:
+            cache.set(key, done.result())
+
+    future = get_batcher().submit(question)
+    future.add_done_callback(cache_vector)
+    return future
+
+
+class QuestionDebouncer:
+    """
+    Encodes the question of one session once it has not changed for `delay` seconds,
+    so quick successive edits only encode the last version. result() encodes right away if still waiting.
+    """
+
+    def __init__(self, delay=QUESTION_DEBOUNCE):
+        self.delay = delay
+        self.question = None
+        self._future = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def update(self, question):
+        """
+        Schedules encoding of the question, unless it is already encoded or pending.
+        A question whose encoding failed is scheduled again.
+        """
+        with self._lock:
+            failed = self._future is not None and self._future.done() and self._future.exception() is not None
+            if question == self.question and not failed:
+                return
+            if self._timer is not None:
+                self._timer.cancel()
+            self.question = question
+            self._future = None
+            self._timer = threading.Timer(self.delay, self._submit, args=(question,))
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _submit(self, question):
+        with self._lock:
+            if question == self.question and self._future is None:
+                self._future = submit_question(question)
+
+    def future(self):
+        """
+        Returns the Future with the embedding of the current question, submitting it now if still waiting.
+        """
+        with self._lock:
+            if self._future is None:
+                if self._timer is not None:
+                    self._timer.cancel()
+                self._future = submit_question(self.question)
+            return self._future
+
+    def result(self, timeout=ENCODE_TIMEOUT):
+        return self.future().result(timeout=timeout)
+
+
+def encode_question(question, timeout=ENCODE_TIMEOUT):
+    """
+    Returns the embedding of the question as a list of floats.
+    Vectors are cached by normalized question text and prompt.
+    """
+    return submit_question(question).result(timeout=timeout)
+
+
+def encode_questions(questions):
+    """
+    Returns the embeddings of many questions, e.g. for a batch job.
+    Cached vectors are reused and all other questions are encoded in one model call.
+    """
+    cache = init_vector_cache()
+    texts = [normalize_question(question) for question in questions]
+    vectors = {text: cache.get(_cache_key(text)) for text in texts}
+
+    missing = [text for text, vector in vectors.items() if vector is None]
+    if missing:
+        with timed('encode_batch'):
+            encoded = encode_batch(missing)
+        increment('encoded_questions', len(missing))
+        for text, vector in zip(missing, encoded):
+            cache.set(_cache_key(text), vector)
+            vectors[text] = vector
+
+    return [vectors[text] for text in texts]
+
+
+def check_backend_parity(questions, backend, tolerance=PARITY_TOLERANCE):
+    """
+    Encodes the questions with the fp32 reference model and with the given backend.
+    Returns:
+    tuple: Cosine similarity for every question, and whether all of them reach the tolerance.
+    """
+    texts = [{'text': normalize_question(question)} for question in questions]
+    reference = build_model('fp32').encode(texts, to_numpy=True, prompt=QUESTION_PROMPT)
+    candidate = build_model(backend).encode(texts, to_numpy=True, prompt=QUESTION_PROMPT)
+
+    cosines = (reference * candidate).sum(axis=1) / (
+            np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1))
+    return cosines.tolist(), bool((cosines >= tolerance).all())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare an encoder backend against the fp32 reference vectors.')
+    parser.add_argument('questions', help='Text file with one question per line')
+    parser.add_argument('--backend', default='int8', choices=ENCODER_BACKENDS)
+    parser.add_argument('--tolerance', type=float, default=PARITY_TOLERANCE)
+    args = parser.parse_args()
+
+    with open(args.questions, 'r') as file:
+        sample = [line.strip() for line in file if line.strip()]
+
+    cosines, passed = check_backend_parity(sample, args.backend, args.tolerance)
+    for question, cosine in zip(sample, cosines):
+        print(f'{cosine:.4f}  {question}')
+    print(f'min cosine {min(cosines):.4f}, tolerance {args.tolerance}: {"OK" if passed else "FAILED"}')
+    raise SystemExit(0 if passed else 1)
@@ -0,0 +1,273 @@
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from caching import LRUCache, SqliteStore
+
+# Summaries are cached per question and retrieved documents
+ANSWER_CACHE_SIZE = 512
+ANSWER_CACHE_TTL = 24 * 60 * 60
+
+CHAT_MODEL_NAME = 'gpt-4-1106-preview'
+
+# Summarization prompt on the LangChain hub, pinned to a commit
+PROMPT_NAME = 'simple-rag:9388b291'
+
+# Hub prompts are kept on disk and only pulled again after this many seconds
+PROMPT_REFRESH_INTERVAL = 24 * 60 * 60
+PROMPT_CACHE_DIR = '.cache/prompts'
+PROMPT_RETRY_INTERVAL = 5 * 60  # seconds between refresh attempts while the hub is unreachable
+PROMPT_PULL_TIMEOUT = 60  # seconds to wait for the hub when there is no copy of the prompt yet
+
+# Cached answers are replayed a few words at a time, so they still stream in the UI
+REPLAY_CHUNK_WORDS = 3
+REPLAY_DELAY = 0.01
+
+_END = object()
+
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+_prompts = {}  # url -> (prompt, pulled at)
+_pulls = {}  # url -> Future of the running pull
+_failed_pulls = {}  # url -> time of the last failed pull
+_prompts_lock = threading.Lock()
+
+
+def create_chat_model(openai_api_key):
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(temperature=0.0, openai_api_key=openai_api_key,
+                      model_name=CHAT_MODEL_NAME)
+
+
+def _read_cached_prompt(path):
+    """
+    Returns the prompt stored at path and when it was pulled, or (None, 0).
+    """
+    if not os.path.exists(path):
+        return None, 0
+    from langchain_core.load import load
+
+    with open(path, 'r') as file:
+        cached = json.load(file)
+    return load(cached['prompt']), cached['fetched_at']
+
+
+def _pull_prompt(url, path, future):
+    try:
+        from langchain import hub
+        from langchain_core.load import dumpd
+
+        prompt, fetched_at = hub.pull(url), time.time()
+        with _prompts_lock:
+            _prompts[url] = (prompt, fetched_at)
+            _failed_pulls.pop(url, None)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump({'url': url, 'fetched_at': fetched_at, 'prompt': dumpd(prompt)}, file)
+        future.set_result(prompt)
+    except Exception as e:
+        logging.warning(f"Could not pull prompt {url}: {e}")
+        with _prompts_lock:
+            _failed_pulls[url] = time.time()
+        future.set_exception(e)
+    finally:
+        with _prompts_lock:
+            _pulls.pop(url, None)
+
+
+def _start_pull(url, path):
+    """
+    Starts pulling the prompt from the hub in a background thread, unless a pull of it is already running.
+    Returns:
+        Future: Resolves to the pulled prompt.
+    """
+    with _prompts_lock:
+        future = _pulls.get(url)
+        if future is None:
+            future = _pulls[url] = Future()
+            threading.Thread(target=_pull_prompt, args=(url, path, future), name='prompt-pull', daemon=True).start()
+    return future
+
+
+def load_prompt(url, cache_dir=PROMPT_CACHE_DIR, refresh_interval=PROMPT_REFRESH_INTERVAL,
+                timeout=PROMPT_PULL_TIMEOUT):
+    """
+    Returns the LangChain hub prompt for url (pin the version with 'name:commit').
+    The prompt is kept in memory and in cache_dir. After refresh_interval it is pulled again in the background,
+    while the stale copy keeps being served. Only without any copy does the caller wait for the hub, up to timeout.
+    """
+    with _prompts_lock:
+        prompt, fetched_at = _prompts.get(url, (None, 0))
+
+    path = os.path.join(cache_dir, hashlib.sha256(url.encode()).hexdigest() + '.json')
+    if prompt is None:
+        prompt, fetched_at = _read_cached_prompt(path)
+        if prompt is not None:
+            with _prompts_lock:
+                prompt, fetched_at = _prompts.setdefault(url, (prompt, fetched_at))
+
+    if prompt is None:
+        return _start_pull(url, path).result(timeout=timeout)
+    with _prompts_lock:
+        # a stale copy is used until the hub is reachable again, retried every PROMPT_RETRY_INTERVAL
+        retry = time.time() - _failed_pulls.get(url, 0) >= PROMPT_RETRY_INTERVAL
+    if time.time() - fetched_at >= refresh_interval and retry:
+        _start_pull(url, path)
+    return prompt
+
+
+def stream_in_background(llm_chat, messages, stop=None, on_done=None):
+    """
+    Starts streaming the chat model answer in a background thread and returns a generator of text chunks.
+    The request is sent right away, so other work (tables, charts) can run while the model generates.
+    The thread runs in a copy of the current context, so langchain callbacks.collect_runs() still sees the run.
+    Setting the stop event (also done when the generator is closed, e.g. because the script was stopped)
+    makes the thread close the model stream at the next chunk. on_done is called when the thread exits.
+    """
+    chunks = queue.Queue()
+    stop = stop or threading.Event()
+
+    def produce():
+        stream = None
+        try:
+            stream = llm_chat.stream(messages)
+            for chunk in stream:
+                if stop.is_set():
+                    break
+                chunks.put(chunk.content)
+        except Exception as e:
+            chunks.put(e)
+        finally:
+            if hasattr(stream, 'close'):
+                stream.close()
+            chunks.put(_END)
+            if on_done:
+                on_done()
+
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(produce,), name='llm-stream', daemon=True).start()
+
+    def consume():
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is _END:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            stop.set()
+
+    return consume()
+
+
+def replay_stream(answer, chunk_words=REPLAY_CHUNK_WORDS, delay=REPLAY_DELAY):
+    """
+    Yields a cached answer in small chunks, for st.write_stream.
+    """
+    words = answer.split(' ')
+    for i in range(0, len(words), chunk_words):
+        yield ' '.join(words[i:i + chunk_words]) + (' ' if i + chunk_words < len(words) else '')
+        time.sleep(delay)
+
+
+class AnswerCache:
+    """
+    Cache of LLM summaries. Answers are grouped by a context key (indexes, filters, date range and the
+    retrieved document ids). Within a group an answer is found by the exact question vector or,
+    if similarity_threshold is set, by the most similar cached question above that cosine similarity.
+    The question vectors for the similarity search are only kept for answers that are in memory.
+    """
+
+    def __init__(self, maxsize=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL, similarity_threshold=None, path=None):
+        self.similarity_threshold = similarity_threshold
+        store = SqliteStore(path, table='answers') if path else None
+        on_evict = self._remove_from_group if similarity_threshold is not None else None
+        self._cache = LRUCache(maxsize, ttl=ttl, store=store, on_evict=on_evict)
+        self._groups = {}  # context key -> {entry key: normalized question vector}
+        self._group_of = {}  # entry key -> context key
+        self._lock = threading.Lock()
+        if similarity_threshold is not None:
+            for key, entry in self._cache.warm():
+                self._add_to_group(entry['context_key'], key, entry['vector'])
+
+    @staticmethod
+    def context_key(selected_index, must_term, doc_ids):
+        payload = json.dumps({"index": selected_index, "must": must_term, "ids": sorted(doc_ids)}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    @staticmethod
+    def _entry_key(question_vector, context_key):
+        vector_hash = hashlib.sha256(np.asarray(question_vector, dtype=np.float32).tobytes()).hexdigest()
+        return f'{context_key}:{vector_hash}'
+
+    def _add_to_group(self, context_key, key, question_vector):
+        if self.similarity_threshold is None:
+            return
+        vector = np.asarray(question_vector, dtype=np.float32)
+        with self._lock:
+            self._groups.setdefault(context_key, {})[key] = vector / np.linalg.norm(vector)
+            self._group_of[key] = context_key
+
+    def _remove_from_group(self, key):
+        with self._lock:
+            context_key = self._group_of.pop(key, None)
+            group = self._groups.get(context_key)
+            if group is not None:
+                group.pop(key, None)
+                if not group:
+                    del self._groups[context_key]
+
+    def get(self, question_vector, context_key):
+        """
+        Returns the cached entry (dict with 'answer' and 'run_id') or None.
+        """
+        entry = self._cache.get(self._entry_key(question_vector, context_key))
+        if entry is not None or self.similarity_threshold is None:
+            return entry
+
+        vector = np.asarray(question_vector, dtype=np.float32)
+        vector = vector / np.linalg.norm(vector)
+        with self._lock:
+            candidates = sorted(((float(vector @ other), key)
+                                 for key, other in self._groups.get(context_key, {}).items()), reverse=True)
+
+        for similarity, key in candidates:
+            if similarity < self.similarity_threshold:
+                break
+            entry = self._cache.get(key)
+            if entry is not None:
+                return entry
+            # expired, or only left in the store
+            self._remove_from_group(key)
+        return None
+
+    def set(self, question_vector, context_key, answer, run_id):
+        key = self._entry_key(question_vector, context_key)
+        self._cache.set(key, {'answer': answer, 'run_id': run_id,
+                              'context_key': context_key, 'vector': list(question_vector)})
+        self._add_to_group(context_key, key, question_vector)
+
+    def stats(self):
+        return self._cache.stats()
+
+
+def init_answer_cache(similarity_threshold=None, path=None):
+    """
+    Creates the process-wide answer cache. With path set, answers are also kept in a sqlite file.
+    """
+    global _answer_cache
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            _answer_cache = AnswerCache(similarity_threshold=similarity_threshold, path=path)
+    return _answer_cache
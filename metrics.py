@@ -0,0 +1,172 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRIC_PREFIX = 'uaby'
+
+_lock = threading.Lock()
+_stages = {}  # stage -> [count, total seconds, max seconds]
+_counters = {}
+_gauges = {}  # name -> (label name, function returning {label value: number})
+_server = None
+
+
+def observe(stage, seconds):
+    """
+    Records one duration for a stage.
+    """
+    with _lock:
+        count, total, maximum = _stages.get(stage, (0, 0.0, 0.0))
+        _stages[stage] = (count + 1, total + seconds, max(maximum, seconds))
+
+
+def increment(counter, value=1):
+    with _lock:
+        _counters[counter] = _counters.get(counter, 0) + value
+
+
+def register_gauge(name, label, collect):
+    """
+    Registers a function that is called on every export, e.g. to report cache statistics.
+    collect returns a dict mapping a label value to a number.
+    """
+    with _lock:
+        _gauges[name] = (label, collect)
+
+
+@contextmanager
+def timed(stage):
+    """
+    Context manager that records how long its block took under the stage name.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+class Trace:
+    """
+    Stage timings of a single search. Every span is also recorded in the process-wide stage metrics.
+    The whole trace is logged as one JSON line, tagged with e.g. the LangSmith run_id.
+    """
+
+    def __init__(self, **tags):
+        self.tags = tags
+        self.spans = {}
+
+    def record(self, stage, seconds):
+        self.spans[stage] = round(seconds, 4)
+        observe(stage, seconds)
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def timed_stream(self, stream, first_stage, total_stage):
+        """
+        Wraps a stream of chunks, recording the time to the first chunk and until the stream ends.
+        Times are measured from this call, not from when the stream is first read,
+        so work done while the stream is already running (e.g. rendering tables) is included.
+        """
+        return self._timed_stream(stream, first_stage, total_stage, time.perf_counter())
+
+    def _timed_stream(self, stream, first_stage, total_stage, start):
+        first = True
+        for chunk in stream:
+            if first:
+                self.record(first_stage, time.perf_counter() - start)
+                first = False
+            yield chunk
+        self.record(total_stage, time.perf_counter() - start)
+
+    def log(self):
+        logging.info(json.dumps({'event': 'search_trace', **self.tags, 'spans': self.spans}, default=str))
+
+
+def render_prometheus():
+    """
+    Returns all metrics in the Prometheus text exposition format.
+    """
+    with _lock:
+        stages = dict(_stages)
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+
+    lines = [f'# TYPE {METRIC_PREFIX}_stage_seconds summary']
+    for stage, (count, total, _) in sorted(stages.items()):
+        lines.append(f'{METRIC_PREFIX}_stage_seconds_count{{stage="{stage}"}} {count}')
+        lines.append(f'{METRIC_PREFIX}_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+    lines.append(f'# TYPE {METRIC_PREFIX}_stage_seconds_max gauge')
+    for stage, (_, _, maximum) in sorted(stages.items()):
+        lines.append(f'{METRIC_PREFIX}_stage_seconds_max{{stage="{stage}"}} {maximum:.6f}')
+
+    for counter, value in sorted(counters.items()):
+        lines.append(f'# TYPE {METRIC_PREFIX}_{counter}_total counter')
+        lines.append(f'{METRIC_PREFIX}_{counter}_total {value}')
+
+    for name, (label, collect) in sorted(gauges.items()):
+        lines.append(f'# TYPE {METRIC_PREFIX}_{name} gauge')
+        try:
+            values = collect()
+        except Exception as e:
+            logging.error(f"Error collecting metric {name}: {e}")
+            continue
+        for label_value, value in sorted(values.items()):
+            lines.append(f'{METRIC_PREFIX}_{name}{{{label}="{label_value}"}} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def snapshot():
+    """
+    Returns all metrics as a dict, for the JSON log or the benchmark report.
+    """
+    with _lock:
+        return {
+            'stages': {stage: {'count': count, 'sum': total, 'max': maximum}
+                       for stage, (count, total, maximum) in _stages.items()},
+            'counters': dict(_counters),
+        }
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    """
+    Serves /metrics on the given local port from a background thread. Only the first call starts the server.
+    """
+    global _server
+    with _lock:
+        if _server is not None:
+            return
+        try:
+            _server = ThreadingHTTPServer((host, port), MetricsHandler)
+        except OSError as e:
+            logging.error(f"Could not start the metrics server on port {port}: {e}")
+            _server = False
+            return
+    threading.Thread(target=_server.serve_forever, name='metrics-server', daemon=True).start()
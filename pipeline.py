@@ -0,0 +1,133 @@
+import threading
+from contextlib import nullcontext
+
+from admission import FlightAbandoned, request_key
+from async_search import search_knn_per_index
+from context import pack_context, format_urls
+from embeddings import ENCODE_TIMEOUT, is_model_ready
+from llm import REPLAY_DELAY, replay_stream, stream_in_background
+from utils import search_knn, search_hybrid, create_dataframe_from_response
+
+
+def answer_question(es_config, selected_index, question, question_debouncer, must_term, llm_chat, prompt_template,
+                    answer_cache, search_slots, llm_slots, search_flights, answer_flights, trace,
+                    retrieval_mode='knn', fan_out=False, max_doc_num=30, render_sources=None, render_summary=None,
+                    on_queue=None, on_shared_wait=None, on_retrieved=None, while_loading=None,
+                    replay_delay=REPLAY_DELAY):
+    """
+    The RUN SEARCH flow: waits for the question embedding, retrieves the documents, then streams the summary
+    from the answer cache, an identical request in flight or the LLM. Used by app.py and benchmark.py.
+    Each stage is recorded as a span of trace.
+
+    The UI is passed in through callbacks, all optional:
+        render_sources(df): shows the sources table, called while the summary is being generated.
+        render_summary(stream): shows the summary chunks as they arrive and returns the whole answer.
+            Without it the stream is just joined.
+        on_queue(position): the request waits for a search or LLM slot at this queue position,
+            None once it stops waiting.
+        on_shared_wait(): the request waits for the answer of an identical request.
+        on_retrieved(response): the documents were retrieved.
+        while_loading(): context manager around the embedding wait while the model is still loading.
+    replay_delay is the delay between the chunks of a cached answer.
+    Returns:
+        dict: The question, answer, sources DataFrame (df), LangSmith run_id, max_doc_num and failed_indexes.
+    """
+    from langchain import callbacks
+
+    def queue_position(position):
+        if on_queue:
+            on_queue(position)
+
+    def retrieve():
+        with search_slots.slot(on_wait=queue_position):
+            queue_position(None)
+            if retrieval_mode in ('hybrid', 'hybrid_es'):
+                return search_hybrid(es_config, selected_index, question, question_vector, must_term,
+                                     k=max_doc_num, server_side=retrieval_mode == 'hybrid_es')
+            elif fan_out:
+                return search_knn_per_index(es_config, selected_index, question_vector, must_term, k=max_doc_num)
+            else:
+                return search_knn(es_config, selected_index, question_vector, must_term, k=max_doc_num)
+
+    llm_stop = threading.Event()
+    answer_owner = False
+    try:
+        with trace.span('encode_wait'):
+            with while_loading() if while_loading and not is_model_ready() else nullcontext():
+                question_vector = question_debouncer.result(timeout=ENCODE_TIMEOUT)
+
+        # Identical searches running at the same time (same vector, indexes and filters) share one request
+        with trace.span('es_search'):
+            response = search_flights.do(request_key(index=selected_index, vector=question_vector, must=must_term,
+                                                     mode=retrieval_mode, fan_out=fan_out, k=max_doc_num),
+                                         retrieve)
+        if response.get('cached'):
+            trace.tags['retrieval_cached'] = True
+        else:
+            trace.tags['es_took_ms'] = response.get('took')
+        if on_retrieved:
+            on_retrieved(response)
+
+        answer_key = answer_cache.context_key(selected_index, must_term,
+                                              [doc['_id'] for doc in response['hits']['hits']])
+        cached_answer = answer_cache.get(question_vector, answer_key)
+        trace.tags['answer_cached'] = bool(cached_answer)
+        if not cached_answer:
+            # Only one session generates the answer for identical requests, the others wait and replay it.
+            # If that session stops or fails, a waiting one generates the answer itself.
+            answer_flight = request_key(context=answer_key, vector=question_vector)
+            cached_answer, answer_owner = answer_flights.join(answer_flight, on_wait=on_shared_wait)
+            queue_position(None)
+            trace.tags['answer_shared'] = not answer_owner
+
+        with callbacks.collect_runs() as cb:
+            if cached_answer:
+                summary_stream = replay_stream(cached_answer['answer'], delay=replay_delay)
+            else:
+                with trace.span('prompt_format'):
+                    # Drop reposts and fit the texts into the prompt token budget
+                    texts_list = pack_context(response['hits']['hits'])
+
+                    # Format urls so they work properly within streamlit
+                    corrected_texts_list = format_urls(texts_list)
+
+                    customer_messages = prompt_template.format_messages(question=question,
+                                                                        texts=corrected_texts_list)
+                # The slot is held until the generation thread exits, and the generation is
+                # stopped if this run is (e.g. by a second click on RUN SEARCH)
+                llm_slots.acquire(on_wait=queue_position)
+                summary_stream = trace.timed_stream(
+                    stream_in_background(llm_chat, customer_messages, stop=llm_stop, on_done=llm_slots.release),
+                    'llm_first_token', 'llm_total')
+                queue_position(None)
+
+            # The sources are rendered first, while the model is still generating
+            with trace.span('dataframe_build'):
+                df = create_dataframe_from_response(response)
+            with trace.span('chart_render'):
+                if render_sources:
+                    render_sources(df)
+
+            answer = render_summary(summary_stream) if render_summary else ''.join(summary_stream)
+
+        if cached_answer:
+            run_id = cached_answer['run_id']
+        else:
+            run_id = cb.traced_runs[0].id if cb.traced_runs else None
+            answer_cache.set(question_vector, answer_key, answer, str(run_id))
+            answer_flights.resolve(answer_flight, {'answer': answer, 'run_id': str(run_id)})
+        trace.tags['run_id'] = run_id
+
+        return {
+            'question': question,
+            'answer': answer,
+            'df': df,
+            'run_id': run_id,
+            'max_doc_num': max_doc_num,
+            'failed_indexes': response.get('failed_indexes', []),
+        }
+    finally:
+        # Also runs when the search is stopped by a rerun
+        llm_stop.set()
+        if answer_owner:
+            answer_flights.resolve(answer_flight, exception=FlightAbandoned())
@@ -1,50 +1,158 @@
+import numpy as np
 import pandas as pd
 import streamlit as st
-import plotly.express as px
 import logging
+import hashlib
+import json
+from datetime import date
+from itertools import islice
 
-from elasticsearch import Elasticsearch
+from elastic_transport import ConnectionError as ESConnectionError
+from tenacity import Retrying, retry_if_exception_type, stop_after_attempt, stop_after_delay, wait_exponential
+
+from caching import LRUCache
+from metrics import increment, observe
 logging.basicConfig(level=logging.INFO)
 
-def get_unique_category_values(index_name, field, es_config):
+# Connection settings for the shared client. Any of these keys can be overridden in es_config.
+ES_CLIENT_DEFAULTS = {
+    'connections_per_node': 25,  # HTTP keep-alive pool size, shared by all sessions
+    'http_compress': True,
+    'request_timeout': 30,
+    'max_retries': 3,
+    'retry_backoff': 0.5,  # seconds, doubled on every retry
+    'retry_backoff_cap': 8,
+    'retry_time_budget': 20,  # seconds, no retry is started after this
+}
+
+# Per-call timeouts (seconds)
+FACET_TIMEOUT = 30
+SEARCH_TIMEOUT = 60
+
+# kNN responses are cached. Time windows that ended before today do not change any more,
+# so they are kept much longer than windows that still receive new documents.
+EMBEDDING_FIELD = "embeddings.WhereIsAI/UAE-Large-V1"
+RETRIEVAL_CACHE_SIZE = 256
+RETRIEVAL_CACHE_TTL_OPEN = 5 * 60
+RETRIEVAL_CACHE_TTL_CLOSED = 24 * 60 * 60
+
+retrieval_cache = LRUCache(RETRIEVAL_CACHE_SIZE, ttl=RETRIEVAL_CACHE_TTL_OPEN)
+
+# Only these _source fields are fetched for hits: the prompt uses translated_text and url,
+# the dataframes use the rest. Leaving out the embeddings saves ~1024 floats per hit.
+HIT_SOURCE_FIELDS = ["translated_text", "text", "url", "date", "country", "language", "category"]
+
+
+@st.cache_resource
+def get_es_client(es_config):
+    """
+    Returns an Elasticsearch client for the given config.
+    The client is cached for the whole process, so all sessions share one connection pool.
     """
-    Retrieve unique values from the field in a specified Elasticsearch index.
+    from elasticsearch import Elasticsearch
+    settings = {**ES_CLIENT_DEFAULTS, **es_config}
+    return Elasticsearch(f'https://{settings["host"]}:{settings["port"]}',
+                         api_key=settings["api_key"],
+                         connections_per_node=settings['connections_per_node'],
+                         http_compress=settings['http_compress'],
+                         request_timeout=settings['request_timeout'],
+                         # retries are done in es_call, with backoff
+                         max_retries=0)
+
+
+def retry_policy(es_config):
+    """
+    Returns the tenacity settings for Elasticsearch calls, shared by the sync and the async client.
+    Only connection errors are retried, with exponential backoff and within the retry time budget.
+    Timeouts are not retried: a search that timed out would most likely time out again,
+    while holding the script thread and loading a cluster that is already slow.
+    """
+    settings = {**ES_CLIENT_DEFAULTS, **es_config}
+    return {'retry': retry_if_exception_type(ESConnectionError),
+            'wait': wait_exponential(multiplier=settings['retry_backoff'], max=settings['retry_backoff_cap']),
+            'stop': (stop_after_attempt(settings['max_retries'] + 1)
+                     | stop_after_delay(settings['retry_time_budget'])),
+            'reraise': True}
+
+
+def es_call(es_config, method, request_timeout=SEARCH_TIMEOUT, **kwargs):
+    """
+    Calls a client method (e.g. 'search') on the shared client with a per-call timeout.
+    Connection errors are retried as set in retry_policy.
+    """
+    es = get_es_client(es_config).options(request_timeout=request_timeout)
+
+    for attempt in Retrying(**retry_policy(es_config)):
+        with attempt:
+            response = getattr(es, method)(**kwargs)
+
+    increment('es_requests')
+    increment('es_payload_bytes', response_size(response))
+    return response
+
+
+def response_size(response):
+    """
+    Returns the size of the response body in bytes, as sent over the wire if the header is available.
+    """
+    content_length = response.meta.headers.get('content-length')
+    if content_length:
+        return int(content_length)
+    return len(json.dumps(response.body))
+
+
+# Facets for the project indexes change slowly, so they are cached for a while
+FACET_CACHE_TTL = 60 * 60
+FACET_CACHE_MAX_ENTRIES = 32
+
+FACET_FIELDS = ['category.keyword', 'language.keyword', 'country.keyword']
+
+
+def get_unique_values_for_fields(index_name, fields, es_config):
+    """
+    Retrieve unique values for several fields with a single aggregation request.
     Returns:
-    list: A list of unique values from the 'category.keyword' field.
+    dict: Field name mapped to a list of its unique values.
     """
-    try:
-        es = Elasticsearch(f'https://{es_config["host"]}:{es_config["port"]}', api_key=es_config["api_key"], request_timeout=300)
-
-        agg_query = {
-            "size": 0,
-            "aggs": {
-                "unique_categories": {
-                    "terms": {"field": field, "size": 10000}
-                }
-            }
-        }
+    aggs = {field: {"terms": {"field": field, "size": 10000}} for field in fields}
 
-        response = es.search(index=index_name, body=agg_query)
-        unique_values = [bucket['key'] for bucket in response['aggregations']['unique_categories']['buckets']]
+    response = es_call(es_config, 'search', request_timeout=FACET_TIMEOUT, index=index_name, size=0, aggs=aggs)
+
+    return {field: [bucket['key'] for bucket in response['aggregations'][field]['buckets']]
+            for field in fields}
+
+
+@st.cache_data(ttl=FACET_CACHE_TTL, max_entries=FACET_CACHE_MAX_ENTRIES, show_spinner=False)
+def load_default_values(index_name, es_config):
+    """
+    Cached facet loading, keyed on the comma-joined index list.
+    The least recently used entry is evicted once max_entries is reached.
+    Failed requests raise, so they are not cached.
+    """
+    unique_values = get_unique_values_for_fields(index_name, FACET_FIELDS, es_config)
+    return tuple(sorted(unique_values[field] + ["Any"]) for field in FACET_FIELDS)
+
+
+def clear_default_values_cache():
+    """
+    Drops all cached facet values, e.g. after new categories were added to the indexes.
+    """
+    load_default_values.clear()
 
-        return unique_values
-    except Exception as e:
-        logging.error(f"Error retrieving unique values from {field}: {e}")
-        return []
 
 def populate_default_values(index_name, es_config):
     """
     Retrieves unique values for specified fields from an Elasticsearch index
     and appends an "Any" option to each list from the specified Elasticsearch index.
     """
-    category_values = get_unique_category_values(index_name, 'category.keyword', es_config)
-    language_values = get_unique_category_values(index_name, 'language.keyword', es_config)
-    country_values = get_unique_category_values(index_name, 'country.keyword', es_config)
-    category_values.append("Any")
-    language_values.append("Any")
-    country_values.append("Any")
+    index_name = ",".join(sorted(index_name.split(",")))
+    try:
+        category_values, language_values, country_values = load_default_values(index_name, es_config)
+    except Exception as e:
+        logging.error(f"Error retrieving unique values from {', '.join(FACET_FIELDS)}: {e}")
+        return ["Any"], ["Any"], ["Any"]
 
-    return sorted(category_values), sorted(language_values), sorted(country_values)
+    return list(category_values), list(language_values), list(country_values)
 
 project_indexes = {
     'ua-by': [
@@ -57,6 +165,25 @@ project_indexes = {
 
 flat_index_list = [index for indexes in project_indexes.values() for index in indexes]
 
+# Mappings for indexes
+index_display_mapping = {
+    "telegram": "ua-by-telegram",
+    "web": "ua-by-web",
+    "facebook": "ua-by-facebook",
+    "youtube": "ua-by-youtube"
+}
+
+# Reverse mapping to display names
+display_index_mapping = {v: k for k, v in index_display_mapping.items()}
+
+# Mapping for project
+project_display_mapping = {
+    "Ua By": "ua-by"
+}
+
+# Reverse mapping for projects
+display_project_mapping = {v: k for k, v in project_display_mapping.items()}
+
 def populate_terms(selected_items, field):
     """
     Creates a list of 'term' queries for Elasticsearch based on selected items.
@@ -101,6 +228,238 @@ def create_must_term(category_terms, language_terms, country_terms, formatted_st
     return must_term
 
 
+def window_is_closed(must_term):
+    """
+    Returns True if the date range in the 'must' term ends before today.
+    """
+    for term in must_term:
+        end_date = term.get("range", {}).get("date", {}).get("lte")
+        if end_date:
+            return end_date < date.today().isoformat()
+    return False
+
+
+def retrieval_cache_key(selected_index, request, source_fields):
+    """
+    Hashes everything that determines a retrieval response: the index list, the request
+    (for kNN: query vector, the 'must' term built by create_must_term, k and num_candidates)
+    and the fetched fields.
+    """
+    payload = json.dumps({"index": selected_index, "request": request, "source": source_fields}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def cache_retrieval(key, response, must_term):
+    """
+    Stores a retrieval response in retrieval_cache. Responses for closed time windows are kept longer.
+    The cached copy is marked with 'cached', so its 'took' is not reported as the time of a new search.
+    """
+    ttl = RETRIEVAL_CACHE_TTL_CLOSED if window_is_closed(must_term) else RETRIEVAL_CACHE_TTL_OPEN
+    retrieval_cache.set(key, {**response, 'cached': True}, ttl=ttl)
+
+
+def create_knn_clause(question_vector, must_term, k, num_candidates, similarity=None):
+    """
+    Constructs the 'knn' section of a search request, filtered by the 'must' term and skipping comments.
+    With similarity set, hits below that raw vector similarity are left out.
+    """
+    knn = {"field": EMBEDDING_FIELD,
+           "query_vector": question_vector,
+           "k": k,
+           "num_candidates": num_candidates,
+           "filter": {
+               "bool": {
+                   "must": must_term,
+                   "must_not": [{"term": {"type": "comment"}}]
+               }
+           }
+           }
+    if similarity is not None:
+        knn["similarity"] = similarity
+    return knn
+
+
+def search_knn(es_config, selected_index, question_vector, must_term, k=30, num_candidates=10000,
+               source_fields=HIT_SOURCE_FIELDS):
+    """
+    Runs a kNN search for the question vector, skipping comments. Hits only contain source_fields.
+    Responses are served from retrieval_cache when the same search was run recently.
+    Returns:
+        dict: The Elasticsearch response body.
+    """
+    knn = create_knn_clause(question_vector, must_term, k, num_candidates)
+
+    key = retrieval_cache_key(selected_index, knn, source_fields)
+    response = retrieval_cache.get(key)
+    if response is None:
+        response = es_call(es_config, 'search', index=selected_index, size=k, knn=knn,
+                           source=source_fields).body
+        observe('es_took', response['took'] / 1000)
+        cache_retrieval(key, response, must_term)
+    logging.info(f"kNN retrieval cache: {retrieval_cache.stats()}")
+
+    return response
+
+
+# Hybrid retrieval: lexical match on translated_text fused with kNN by reciprocal rank.
+# Names, places and unit designations are found by the lexical query, so kNN needs far fewer candidates.
+HYBRID_NUM_CANDIDATES = 1000
+RRF_RANK_CONSTANT = 60
+RRF_RANK_WINDOW = 50  # hits taken from each ranking before fusion
+HYBRID_WEIGHTS = {"knn": 1.0, "lexical": 1.0}
+
+
+def create_lexical_query(question, must_term):
+    """
+    Constructs a 'match' query on translated_text with the same filters as the kNN search.
+    """
+    return {
+        "bool": {
+            "must": [{"match": {"translated_text": {"query": question}}}],
+            "filter": must_term,
+            "must_not": [{"term": {"type": "comment"}}]
+        }
+    }
+
+
+def reciprocal_rank_fusion(ranked_lists, weights, k, rank_constant=RRF_RANK_CONSTANT):
+    """
+    Merges ranked hit lists: each hit scores the sum of weight / (rank_constant + rank) over the lists it is in.
+    Returns:
+        list: The top k hits (copies) with the fused score as '_score'.
+    """
+    scores = {}
+    hits_by_key = {}
+    for hits, weight in zip(ranked_lists, weights):
+        for rank, hit in enumerate(hits, start=1):
+            key = (hit.get('_index'), hit['_id'])
+            scores[key] = scores.get(key, 0.0) + weight / (rank_constant + rank)
+            hits_by_key.setdefault(key, hit)
+
+    top_keys = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [{**hits_by_key[key], '_score': scores[key]} for key in top_keys]
+
+
+def search_hybrid(es_config, selected_index, question, question_vector, must_term, k=30,
+                  num_candidates=HYBRID_NUM_CANDIDATES, weights=None, server_side=False,
+                  source_fields=HIT_SOURCE_FIELDS):
+    """
+    Runs the lexical and the kNN query and fuses their rankings with reciprocal rank fusion.
+    With server_side, the fusion is done by an Elasticsearch 'rrf' retriever (8.14+, no weights);
+    otherwise both queries are sent in one _msearch and fused here with the given weights.
+    Responses are cached in retrieval_cache like in search_knn.
+    Returns:
+        dict: A response-like dict with the fused hits.
+    """
+    weights = weights or HYBRID_WEIGHTS
+    window = max(RRF_RANK_WINDOW, k)
+    knn = create_knn_clause(question_vector, must_term, window, max(num_candidates, window))
+    lexical_query = create_lexical_query(question, must_term)
+
+    request = {"knn": knn, "query": lexical_query, "weights": weights, "server_side": server_side}
+    key = retrieval_cache_key(selected_index, request, source_fields)
+    response = retrieval_cache.get(key)
+    if response is not None:
+        return response
+
+    if server_side:
+        retriever = {
+            "rrf": {
+                "retrievers": [{"standard": {"query": lexical_query}}, {"knn": knn}],
+                "rank_window_size": window,
+                "rank_constant": RRF_RANK_CONSTANT
+            }
+        }
+        response = es_call(es_config, 'search', index=selected_index, size=k, retriever=retriever,
+                           source=source_fields).body
+    else:
+        header = {"index": selected_index}
+        searches = [header, {"size": window, "knn": knn, "_source": source_fields},
+                    header, {"size": window, "query": lexical_query, "_source": source_fields}]
+        responses = es_call(es_config, 'msearch', searches=searches)['responses']
+
+        ranked_lists = []
+        list_weights = []
+        for name, result in zip(["knn", "lexical"], responses):
+            if 'error' in result:
+                logging.warning(f"{name} part of the hybrid search failed: {result['error']}")
+                continue
+            ranked_lists.append(result['hits']['hits'])
+            list_weights.append(weights[name])
+        if not ranked_lists:
+            raise RuntimeError(f"Hybrid search failed: {responses[0]['error']}")
+
+        response = {"took": max(result.get('took', 0) for result in responses),
+                    "hits": {"hits": reciprocal_rank_fusion(ranked_lists, list_weights, k)}}
+
+    cache_retrieval(key, response, must_term)
+    return response
+
+
+# Columns of the sources table: (column, _source field, default for missing values)
+DATAFRAME_COLUMNS = [
+    ('date', 'date', ''),
+    ('text', 'text', ''),
+    # ('translated_text', 'translated_text', ''),
+    ('url', 'url', ''),
+    ('country', 'country', 'None'),
+    ('language', 'language', 'None'),
+    ('category', 'category', 'None'),
+]
+CATEGORICAL_COLUMNS = ['country', 'language', 'category']
+
+
+def create_dataframe_from_hits(hits, columns, id_column=None, score_column=None, score_threshold=None):
+    """
+    Builds a DataFrame column by column from Elasticsearch hits.
+    Each field is copied into a preallocated array in a single pass over the hits, the hits are not modified.
+    Rows scoring below score_threshold are dropped with a mask, dates are parsed in one go
+    and country, language and category become categoricals.
+    Returns:
+        pd.DataFrame: One row per kept hit.
+    """
+    n = len(hits)
+    values = {column: np.empty(n, dtype=object) for column, _, _ in columns}
+    ids = np.empty(n, dtype=object)
+    scores = np.empty(n, dtype=float)
+
+    for i, hit in enumerate(hits):
+        source = hit.get('_source', {})
+        for column, field, default in columns:
+            values[column][i] = source.get(field, default)
+        ids[i] = hit.get('_id', '')
+        scores[i] = hit.get('_score') or 0.0
+
+    mask = scores >= score_threshold if score_threshold is not None else np.ones(n, dtype=bool)
+    data = {column: values[column][mask] for column, _, _ in columns}
+    if score_column:
+        data[score_column] = scores[mask]
+    if id_column:
+        data[id_column] = ids[mask]
+    df = pd.DataFrame(data)
+
+    return set_column_types(df)
+
+
+def set_column_types(df):
+    """
+    Parses the date column and turns the low-cardinality columns into categoricals.
+    """
+    if 'date' in df.columns:
+        # Only the calendar date is kept. Cutting off the time and offset first lets dates and timestamps
+        # in any ISO 8601 form parse, so only bad values become NaT (and are logged).
+        dates = df['date'].astype('string')
+        parsed = pd.to_datetime(dates.str.slice(0, 10), format='ISO8601', errors='coerce')
+        invalid = parsed.isna() & dates.fillna('').ne('')
+        if invalid.any():
+            logging.warning(f"Could not parse {invalid.sum()} dates, e.g. {dates[invalid].iloc[0]!r}")
+        df['date'] = parsed.dt.date
+    for column in CATEGORICAL_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+    return df
+
+
 def create_dataframe_from_response(response):
     """
     Creates a pandas DataFrame from Elasticsearch response data.
@@ -108,37 +467,34 @@ def create_dataframe_from_response(response):
         pd.DataFrame: A DataFrame containing the selected fields from the response.
     """
     try:
-        selected_documents = []
-
         if 'hits' not in response or 'hits' not in response['hits']:
             print("No data found in the response.")
             return pd.DataFrame()  # Return an empty DataFrame
 
-        for doc in response['hits']['hits']:
-            selected_doc = {
-                'date': doc['_source'].get('date', ''),
-                'text': doc['_source'].get('text', ''),
-                # 'translated_text': doc['_source'].get('translated_text', ''),
-                'url': doc['_source'].get('url', ''),
-                'country': doc['_source'].get('country', 'None'),
-                'language': doc['_source'].get('language', 'None'),
-                'category': doc['_source'].get('category', 'None'),
-                'id': doc.get('_id', '')
-            }
-            selected_documents.append(selected_doc)
-
-        df_selected_fields = pd.DataFrame(selected_documents)
-
-        if 'date' in df_selected_fields.columns:
-            df_selected_fields['date'] = pd.to_datetime(df_selected_fields['date']).dt.date
-
-        return df_selected_fields
+        return create_dataframe_from_hits(response['hits']['hits'], DATAFRAME_COLUMNS, id_column='id')
 
     except Exception as e:
         print(f"An error occurred: {e}")
         return pd.DataFrame()
 
 
+def count_values(series, name):
+    """
+    Counts the values of a column, most frequent first. Categorical columns are counted from their codes.
+    Returns:
+        pd.DataFrame: Columns name and 'count'.
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        codes = series.cat.codes.to_numpy()
+        counts = np.bincount(codes[codes >= 0], minlength=len(series.cat.categories))
+        counts_df = pd.DataFrame({name: series.cat.categories.astype(object), 'count': counts})
+        return counts_df[counts_df['count'] > 0].sort_values('count', ascending=False, kind='stable')
+
+    counts_df = series.value_counts().reset_index()
+    counts_df.columns = [name, 'count']
+    return counts_df
+
+
 def display_distribution_charts(df):
     """
     Displays donut charts for category, language, and country distributions in Streamlit.
@@ -149,68 +505,92 @@ def display_distribution_charts(df):
         st.write("No data available to display.")
         return
 
+    import plotly.express as px
+
     col1, col2, col3 = st.columns(3)
 
     if 'category' in df.columns:
-        category_counts = df['category'].value_counts().reset_index()
-        category_counts.columns = ['category', 'count']
+        category_counts = count_values(df['category'], 'category')
         fig_category = px.pie(category_counts, names='category', values='count',
                               title='Category Distribution', hole=0.4)
         col1.plotly_chart(fig_category, use_container_width=True)
 
     if 'language' in df.columns:
-        language_counts = df['language'].value_counts().reset_index()
-        language_counts.columns = ['language', 'count']
+        language_counts = count_values(df['language'], 'language')
         fig_language = px.pie(language_counts, names='language', values='count',
                               title='Language Distribution', hole=0.4)
         col2.plotly_chart(fig_language, use_container_width=True)
 
     if 'country' in df.columns:
-        country_counts = df['country'].value_counts().reset_index()
-        country_counts.columns = ['country', 'count']
+        country_counts = count_values(df['country'], 'country')
         fig_country = px.pie(country_counts, names='country', values='count',
                              title='Country Distribution', hole=0.4)
         col3.plotly_chart(fig_country, use_container_width=True)
 
-def create_dataframe_from_response_filtered(response, score_threshold=0.7):
-    records = []
-    for hit in response['hits']['hits']:
-        if hit['_score'] >= score_threshold:
-            source = hit['_source']
-            similarity_score = hit['_score']
-            source['similarity_score'] = similarity_score
-            records.append(source)
+# Deep retrieval pages through hits instead of asking for everything in one response
+SCORE_THRESHOLD = 0.7
+KNN_K = 100
+CHUNK_SIZE = 1000
+
+
+def score_to_similarity(score):
+    """
+    Converts a kNN _score into the raw cosine similarity used by the knn 'similarity' parameter
+    (for cosine, Elasticsearch scores hits as (1 + cosine) / 2).
+    """
+    return 2 * score - 1
 
-    df = pd.DataFrame(records)
+
+def create_dataframe_from_response_filtered(response, score_threshold=SCORE_THRESHOLD,
+                                            source_fields=HIT_SOURCE_FIELDS):
+    columns = [(field, field, None) for field in source_fields]
+    df = create_dataframe_from_hits(response['hits']['hits'], columns,
+                                    score_column='similarity_score', score_threshold=score_threshold)
 
     return df
 
-def search_elastic_below_threshold(es_config, selected_index, question_vector, must_term, max_doc_num=10000):
+
+def iter_hits_above_threshold(es_config, selected_index, question_vector, must_term, score_threshold=SCORE_THRESHOLD,
+                              k=KNN_K, num_candidates=10000, source_fields=HIT_SOURCE_FIELDS):
+    """
+    Runs one kNN search for the k nearest hits. Hits scoring below the threshold are already
+    dropped by Elasticsearch (knn 'similarity'), so only the relevant hits are transferred.
+    Yields:
+        dict: The source fields of a hit plus its 'similarity_score'.
+    """
+    knn = create_knn_clause(question_vector, must_term, k, max(num_candidates, k),
+                            similarity=score_to_similarity(score_threshold))
+    response = es_call(es_config, 'search', index=selected_index, size=k, knn=knn, source=source_fields,
+                       track_total_hits=False)
+
+    for hit in response['hits']['hits']:
+        yield {**hit['_source'], 'similarity_score': hit['_score']}
+
+
+def create_dataframe_from_rows(rows, chunk_size=CHUNK_SIZE):
+    """
+    Builds a DataFrame from an iterable of row dicts, chunk_size rows at a time,
+    so only one chunk of dicts is held in memory at once.
+    """
+    chunks = []
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        chunks.append(pd.DataFrame(chunk))
+
+    return set_column_types(pd.concat(chunks, ignore_index=True)) if chunks else pd.DataFrame()
+
+
+def search_elastic_below_threshold(es_config, selected_index, question_vector, must_term, max_doc_num=10000,
+                                   source_fields=HIT_SOURCE_FIELDS):
     try:
-        es = Elasticsearch(f'https://{es_config["host"]}:{es_config["port"]}', api_key=es_config["api_key"],
-                           request_timeout=600)
-
-        response = es.search(index=selected_index,
-                             size=max_doc_num,
-                             knn={"field": "embeddings.WhereIsAI/UAE-Large-V1",
-                                  "query_vector": question_vector,
-                                  "k": 100,
-                                  "num_candidates": 10000,
-                                  # "similarity": 20, # l2 norm, so not the [0,1]
-                                  "filter": {
-                                      "bool": {
-                                          "must": must_term
-                                      }
-                                  }
-                                  }
-                             )
-        df = create_dataframe_from_response_filtered(response)
+        rows = iter_hits_above_threshold(es_config, selected_index, question_vector, must_term,
+                                         k=min(KNN_K, max_doc_num), source_fields=source_fields)
+        df = create_dataframe_from_rows(rows)
         return df
 
     except Exception as e:
         st.error(f'Failed to connect to Elasticsearch: {str(e)}')
 
         return None
-
-
-